@@ -0,0 +1,145 @@
+# Comptes rendus mixtes : certaines pages contiennent du texte sélectionnable, d'autres sont scannées.
+# Les pages texte passent par camelot (TextMachina), les pages image par la chaîne OCR (OCRobot),
+# puis les résultats sont fusionnés en un seul tableau par examen, déposé dans pdf_extracted
+# pour suivre les corrections de TextMachina.
+
+import os
+import sys
+import time
+import pandas as pd
+from pypdf import PdfReader
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+# The branch modules import their siblings by bare name
+for branch in ['OCRobot', 'TextMachina']:
+    branch_dir = os.path.join(base_dir, branch)
+    if branch_dir not in sys.path:
+        sys.path.append(branch_dir)
+
+from PdfToImageConverter_optimized import PdfConverter
+from ImagePreprocessor_optimized import ImagePreprocessor
+from OCRProcessor_optimized import TextExtractorFromImages
+from ExcelFormatter import DataReshaper, as_read_from_excel
+from PDFPlumber_refactored import PDFProcessor
+from PdfTriage import classify_pdf, read_page_manifest
+
+
+class HybridPipeline:
+    def __init__(self, folder_path, output_folder=os.path.join(base_dir, 'TextMachina', 'pdf_test', 'pdf_extracted')):
+        # output_folder: pdf_extracted folder of the TextMachina run the merged tables go through
+        self.folder_path = folder_path
+        self.output_folder = output_folder
+        self.pdf_converter = PdfConverter(folder_path)
+        self.image_preprocessor = ImagePreprocessor(folder_path)
+        self.text_extractor = TextExtractorFromImages(folder_path)
+        self.pdf_processor = PDFProcessor(directory_path=folder_path, output_path=folder_path)
+
+    def page_routes(self, pdf_path, manifest):
+        """
+        Splits the pages of a PDF between camelot and OCR.
+
+        The image-only pages come from the manifest written during triage, so
+        pages are not classified again. PDFs dropped in the folder by hand are
+        classified here, still once per page.
+
+        Returns:
+            tuple: (text_pages, image_pages), 1-based page numbers.
+        """
+        with open(pdf_path, 'rb') as pdf_file:
+            page_count = len(PdfReader(pdf_file).pages)
+        filename = os.path.basename(pdf_path)
+        if filename in manifest:
+            image_pages = manifest[filename]
+        else:
+            image_pages = classify_pdf(pdf_path).image_pages or []
+        text_pages = [page for page in range(1, page_count + 1) if page not in image_pages]
+        return text_pages, list(image_pages)
+
+    def extract_text_pages(self, pdf_path, text_pages):
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        tables_path = os.path.join(self.folder_path, f"{base_name}_tables.xlsx")
+        pages = ','.join(str(page) for page in text_pages)
+        # process_pdf logs a failure of camelot and returns False: the scanned pages of the
+        # document are still left to the OCR
+        if not self.pdf_processor.process_pdf(pdf_path, tables_path, pages=pages):
+            if os.path.exists(tables_path):
+                os.remove(tables_path)
+            return None
+        try:
+            # Measures as rows and dates as columns, turned into one row per date like OCRobot
+            combined_df = self.pdf_processor.combine_data_horizontally(tables_path)
+        except Exception as e:
+            print(f"No table extracted from the text pages of {pdf_path}: {e}")
+            return None
+        finally:
+            os.remove(tables_path)
+        text_df = combined_df.transpose()
+        text_df.index.name = 'Date'
+        return text_df.reset_index()
+
+    def extract_image_pages(self, pdf_path, image_pages):
+        self.pdf_converter.convert_pdf_to_image(pdf_path, self.folder_path, pages=image_pages)
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
+        reshaped_dfs = []
+        for page in image_pages:
+            image_path = os.path.join(self.folder_path, f'{base_name}{page - 1}.png')
+            self.image_preprocessor._preprocess_image(image_path)
+            table = self.text_extractor._process_file(image_path)
+            os.remove(image_path)
+            # A scanned page without results table (annex, blank page) is left out, not the document
+            if not self.text_extractor.usable_table(table, f'{base_name}{page - 1}'):
+                continue
+            # Typed as in OCRobot, where the table goes through an xlsx before the reshape
+            df = as_read_from_excel(pd.DataFrame(table))
+            reshaped_dfs.append(DataReshaper(df).reshape())
+        if not reshaped_dfs:
+            return None
+        return pd.concat(reshaped_dfs, ignore_index=True)
+
+    def process_pdf(self, pdf_path, manifest):
+        text_pages, image_pages = self.page_routes(pdf_path, manifest)
+        print(f"{os.path.basename(pdf_path)}: text pages {text_pages}, image pages {image_pages}")
+        exam_dfs = []
+        if text_pages:
+            text_df = self.extract_text_pages(pdf_path, text_pages)
+            if text_df is not None:
+                exam_dfs.append(text_df)
+        if image_pages:
+            image_df = self.extract_image_pages(pdf_path, image_pages)
+            if image_df is not None:
+                exam_dfs.append(image_df)
+        if not exam_dfs:
+            print(f"Nothing extracted from {pdf_path}")
+            return False
+
+        exam_df = pd.concat(exam_dfs, ignore_index=True)
+        # Laid out like the pdf_extracted files of TextMachina, measures as rows and dates as columns
+        extracted_df = exam_df.set_index('Date').transpose()
+        extracted_df.columns.name = None
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        output_path = os.path.join(self.output_folder, f"{base_name}.xlsx")
+        extracted_df.to_excel(output_path)
+        print(f"Saved merged table to: {output_path}")
+        return True
+
+    def run(self):
+        start_time = time.time()
+        os.makedirs(self.output_folder, exist_ok=True)
+        manifest = read_page_manifest(self.folder_path)
+        pdf_files = [file for file in os.listdir(self.folder_path) if file.lower().endswith('.pdf')]
+
+        processed_files = 0
+        for pdf_file in pdf_files:
+            try:
+                if self.process_pdf(os.path.join(self.folder_path, pdf_file), manifest):
+                    processed_files += 1
+            except Exception as e:
+                print(f"Error processing {pdf_file}: {e}")
+
+        duration = time.time() - start_time
+        print(f"Hybrid pipeline processed {processed_files}/{len(pdf_files)} files in {duration:.2f} seconds.")
+
+
+if __name__ == "__main__":
+    pipeline = HybridPipeline(os.path.join(base_dir, 'pdf_Hybrid'))
+    pipeline.run()
@@ -1,52 +1,49 @@
-from pypdf import PdfReader
-from pypdf.errors import EmptyFileError  # Add this line to import the exception
-from pypdf.errors import PdfStreamError
+import argparse
 import shutil
 import os
+import sys
 from collections import defaultdict
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PdfTriage import (TriageCache, classify_pdf, ipp_and_date_from_filename, plan_latest_per_ipp,
+                       triage_pdfs)
 
 
 def is_not_selectable_text(pdf_path):
-    try:
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text = page.extract_text()
-                if text.strip():
-                    return False
-    except (PdfStreamError, EmptyFileError) as e:
-        print(f"Error processing file {pdf_path}: {e}")
-    return True
-
-
-def get_id_and_date_from_filename(filename):
-    # Assuming filenames are in the format "IPP_date_other-id-for-specific-document.pdf"
-    parts = filename.split('_')
-    if len(parts) >= 2:
-        return parts[0], parts[1]
-    return None, None
-
-
-def copy_pdfs_with_criteria(input_folder, output_folder):
-    # Get the list of all PDF files in the input folder
-    pdf_files = [os.path.join(root, f) for root, _, files in os.walk(input_folder) for f in files if f.endswith('.pdf')]
-    total_files = len(pdf_files)
+    # A single page with text is enough to rule out a scanned PDF
+    return classify_pdf(pdf_path, stop_at_text=True).scanned
+
+
+def iter_pdf_files(input_folder):
+    for root, _, files in os.walk(input_folder):
+        for f in files:
+            if f.endswith('.pdf'):
+                yield os.path.join(root, f)
+
+
+def copy_pdfs_with_criteria(input_folder, output_folder, workers=1, cache=None):
+    if workers > 1:
+        # Files are classified while the walk is still running, so the total is unknown
+        pdf_files = iter_pdf_files(input_folder)
+        total_files = None
+    else:
+        # Get the list of all PDF files in the input folder
+        pdf_files = list(iter_pdf_files(input_folder))
+        total_files = len(pdf_files)
+        if total_files == 0:
+            print("No PDF files found in the directory.")
+            return
     processed_files = 0
 
-    if total_files == 0:
-        print("No PDF files found in the directory.")
-        return
-
     # Default date to older one
     latest_files = defaultdict(lambda: ('', '0000-00-00'))
 
-    for pdf_path in pdf_files:
+    # Verdicts come back in walk order, so the reduction below matches the serial run
+    for pdf_path, verdict in triage_pdfs(pdf_files, workers, stop_at_text=True, cache=cache):
         print(f"Checking file: {pdf_path}")  # Debug print to check file detection
         try:
-            if is_not_selectable_text(pdf_path):
+            if verdict.scanned:
                 filename = os.path.basename(pdf_path)
-                id, date = get_id_and_date_from_filename(filename)
+                id, date = ipp_and_date_from_filename(filename)
                 # If this file is newer than the one stored
                 if date > latest_files[id][1]:
                     latest_files[id] = (filename, date)
@@ -59,21 +56,54 @@ def copy_pdfs_with_criteria(input_folder, output_folder):
             print(f"Error processing {pdf_path}: {e}")
 
         processed_files += 1
-        progress = (processed_files / total_files) * 100
-        print(f"Processing... {processed_files}/{total_files} ({progress:.2f}%)")
+        if total_files:
+            progress = (processed_files / total_files) * 100
+            print(f"Processing... {processed_files}/{total_files} ({progress:.2f}%)")
+        else:
+            print(f"Processing... {processed_files} files checked")
+
+    if processed_files == 0:
+        print("No PDF files found in the directory.")
 
 
 
+def copy_latest_pdfs(input_folder, output_folder, workers=1, cache=None):
+    # Only the newest scanned exam of each IPP is classified and copied, older ones are skipped
+    winners = plan_latest_per_ipp(iter_pdf_files(input_folder), lambda verdict: verdict.scanned,
+                                  workers, stop_at_text=True, cache=cache)
+    for pdf_path, _ in winners.values():
+        destination_path = os.path.join(output_folder, os.path.basename(pdf_path))
+        print(f"Copying file {pdf_path} to {destination_path}")
+        try:
+            shutil.copy(pdf_path, destination_path)
+        except Exception as e:
+            print(f"Error processing {pdf_path}: {e}")
 
-def main():
+
+def main(use_hash=False, workers=None):
+    # use_hash: also key the cached verdicts by file content, so moved or touched PDFs are hits
+    # workers: processes classifying PDFs, 1 for a serial run (default: one per CPU)
     input_folder = "C:/Users/benysar/Desktop/LUTECE/extract_easily/"
     output_folder = "../pdf_OCRobot"
+    if workers is None:
+        workers = os.cpu_count() or 1
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    copy_pdfs_with_criteria(input_folder, output_folder)
+    # Verdicts of unchanged PDFs are reused from the previous runs
+    cache = TriageCache(output_folder, use_hash)
+    try:
+        copy_latest_pdfs(input_folder, output_folder, workers, cache)
+    finally:
+        cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Copy the newest scanned PDF of each IPP to pdf_OCRobot.")
+    parser.add_argument('--use-hash', action='store_true',
+                        help="Also key the cached verdicts by file content")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes classifying PDFs, 1 for a serial run (default: one per CPU)")
+    args = parser.parse_args()
+    main(args.use_hash, args.workers)
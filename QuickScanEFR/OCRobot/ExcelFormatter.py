@@ -1,30 +1,68 @@
+import numpy as np
 import pandas as pd
 
 
+def as_read_from_excel(df: pd.DataFrame) -> pd.DataFrame:
+    # Types a frame the way a to_excel/read_excel round trip does (empty strings become NaN,
+    # all-numeric columns become numbers), so in-memory results match the xlsx path
+    df = df.replace('', np.nan)
+    for column in df.columns:
+        try:
+            df[column] = pd.to_numeric(df[column])
+        except (ValueError, TypeError):
+            pass
+    return df
+
+
+def format_patient_table(df: pd.DataFrame) -> pd.DataFrame:
+    # Dates as dd/mm/yyyy, volumes from L to mL and percentages as fractions
+    df["Date"] = pd.to_datetime(
+        df["Date"], dayfirst=True).dt.strftime('%d/%m/%Y')
+
+    # I assume that if % not in column name then it is in L
+    no_perc = [
+        e for e in df.columns if "%" not in e and "Date" not in e]
+    perc = [e for e in df.columns if "%" in e]
+    for c in no_perc:
+        df[c] = df[c]*1000
+
+    for c in perc:
+        df[c] = df[c]/100
+    return df
+
+
 class DataReshaper:
+    # Rows that only carry the test date and time, not a measure
+    MARKERS = ['Date test', 'Heure test']
+
     def __init__(self, df: pd.DataFrame):
         self.df = df
 
-    def reshape(self) -> pd.DataFrame:
-        reshaped_dataframes = []
-        date_indices = self.df[self.df['Paramètres']
-                               == 'Date test'].index.tolist()
-        for start_idx in date_indices:
-            end_idx = date_indices[date_indices.index(
-                start_idx) + 1] if date_indices.index(start_idx) + 1 < len(date_indices) else len(self.df)
-            slice_df = self.df.iloc[start_idx:end_idx].copy()
-            date = slice_df.loc[slice_df['Paramètres']
-                                == 'Date test', 'Pré'].values[0]
-            slice_pivot = slice_df.pivot_table(
-                index='Paramètres', values='Pré', aggfunc='first').reset_index()
-            reshaped_slice = pd.DataFrame({'Date': [date]})
-            for col in slice_pivot['Paramètres']:
-                reshaped_slice[col] = slice_pivot.loc[slice_pivot['Paramètres']
-                                                      == col, 'Pré'].values[0]
-            if 'Date test' in reshaped_slice:
-                reshaped_slice = reshaped_slice.drop(columns=['Date test'])
-            if 'Heure test' in reshaped_slice:
-                reshaped_slice = reshaped_slice.drop(columns=['Heure test'])
-            reshaped_dataframes.append(reshaped_slice)
-        final_df = pd.concat(reshaped_dataframes, ignore_index=True)
-        return final_df
+    def reshape(self, document_column=None) -> pd.DataFrame:
+        # One row per 'Date test' marker: every row gets the number of markers seen so far
+        # as its group id, and a single pivot spreads the Pré values of each group.
+        # document_column: frame of several documents concatenated; groups stop at the
+        # document boundaries and the column is kept in front of the output
+        df = self.df.reset_index(drop=True)
+        is_marker = df['Paramètres'] == 'Date test'
+        group = is_marker.cumsum()
+        if document_column is None:
+            in_group = group > 0
+        else:
+            # Rows before the first marker of their document are dropped, as in a single document
+            in_group = is_marker.groupby(df[document_column]).cumsum() > 0
+        df = df[in_group].assign(_group=group[in_group])
+
+        markers = df[is_marker[in_group]]
+        output = pd.DataFrame({'Date': markers['Pré'].to_numpy()}, index=markers['_group'])
+        if document_column is not None:
+            output.insert(0, document_column, markers[document_column].to_numpy())
+
+        values = df[~df['Paramètres'].isin(self.MARKERS)]
+        pivot = values.pivot_table(index='_group', columns='Paramètres', values='Pré', aggfunc='first')
+        # Same column order as concatenating one sorted pivot per group: by first group, then name
+        first_group = pivot.notna().idxmax()
+        columns = sorted(pivot.columns, key=lambda column: (first_group[column], column))
+        output = output.join(pivot[columns])
+        output.columns.name = None
+        return output.reset_index(drop=True).infer_objects()
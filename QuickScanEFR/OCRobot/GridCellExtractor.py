@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+
+
+class GridCellExtractor:
+    """
+    Reads a ruled results table cell by cell.
+
+    The horizontal and vertical rules of the preprocessed crop give the cell
+    boundaries; every non-empty cell is OCR'd on its own as a single line, with
+    a text config for the parameter names and a numeric one for the values. The
+    cells of a column go to Tesseract together, in a single run.
+    """
+
+    # Rules are runs of ink at least this fraction of the crop width (or height) long
+    LINE_FRACTION = 1 / 8
+    # Cells thinner than this (pixels) are gaps between doubled rules
+    MIN_CELL = 20
+    # Pixels trimmed inside each cell so the rules don't reach Tesseract
+    CELL_PADDING = 6
+    # Cells with less ink than this fraction of their area are empty
+    MIN_INK = 0.002
+    TEXT_CONFIG = '--psm 7'
+    # Digits plus the separators of dates (12/03/2015), times (10:30) and decimals
+    NUMERIC_CONFIG = '--psm 7 -c tessedit_char_whitelist=0123456789.,:/-'
+
+    def __init__(self, ocr_batch):
+        # ocr_batch: function (images, config) -> texts OCR'ing the images in one Tesseract run
+        # (TextExtractorFromImages._ocr_images); cells are OCR'd serially, inside the pool worker
+        self.ocr_batch = ocr_batch
+
+    def settings(self):
+        # Everything that shapes the cells and their OCR, for the OCR cache key
+        return (f"line={self.LINE_FRACTION};min_cell={self.MIN_CELL};padding={self.CELL_PADDING};"
+                f"min_ink={self.MIN_INK};text={self.TEXT_CONFIG};numeric={self.NUMERIC_CONFIG}")
+
+    @staticmethod
+    def _rule_spans(mask):
+        # (first, last) index of each run of consecutive True values
+        indices = np.flatnonzero(mask)
+        if not len(indices):
+            return []
+        breaks = np.flatnonzero(np.diff(indices) > 1)
+        starts = np.concatenate(([indices[0]], indices[breaks + 1]))
+        ends = np.concatenate((indices[breaks], [indices[-1]]))
+        return list(zip(starts, ends))
+
+    def _cell_bounds(self, spans, size):
+        # Cells lie between consecutive rules; the crop edges close an open border
+        edges = [(-1, -1)] + spans + [(size, size)]
+        return [(end + 1, start) for (_, end), (start, _) in zip(edges, edges[1:])
+                if start - end - 1 >= self.MIN_CELL]
+
+    def detect_cells(self, image):
+        """
+        Finds the row and column bounds of the grid in a binarized crop (black ink on white).
+
+        Returns:
+            tuple: (rows, columns), lists of (start, stop) pixel bounds.
+        """
+        height, width = image.shape
+        ink = cv2.bitwise_not(image)
+        horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (max(1, int(width * self.LINE_FRACTION)), 1)))
+        vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (1, max(1, int(height * self.LINE_FRACTION)))))
+        rows = self._cell_bounds(self._rule_spans(horizontal.any(axis=1)), height)
+        columns = self._cell_bounds(self._rule_spans(vertical.any(axis=0)), width)
+        return rows, columns
+
+    def _ocr_cells(self, cells, config):
+        # Only the cells with ink go to Tesseract, all in one run
+        inked = [i for i, cell in enumerate(cells)
+                 if cell.size and np.count_nonzero(cell < 128) >= self.MIN_INK * cell.size]
+        texts = [''] * len(cells)
+        if inked:
+            for i, text in zip(inked, self.ocr_batch([cells[i] for i in inked], config)):
+                texts[i] = ' '.join(text.split())
+        return texts
+
+    @staticmethod
+    def _column_name(header):
+        header = header.replace(' ', '')
+        if '%' in header or '*' in header:
+            return '% Théo'
+        if header.startswith('Th'):
+            return 'Théo'
+        if header.startswith('Pr'):
+            return 'Pré'
+        return None
+
+    def extract(self, image):
+        """
+        OCRs every cell of the grid of a binarized crop.
+
+        The first row holds the headers; the first column the parameter names.
+
+        Returns:
+            dict: Columns Paramètres, Théo, Pré and % Théo, one entry per row below
+            the headers, or None when no grid with those headers is found.
+        """
+        rows, columns = self.detect_cells(image)
+        if len(rows) < 2 or len(columns) < 4:
+            return None
+        padding = self.CELL_PADDING
+        cells = [[image[top + padding:bottom - padding, left + padding:right - padding]
+                  for left, right in columns] for top, bottom in rows]
+        configs = [self.TEXT_CONFIG] + [self.NUMERIC_CONFIG] * (len(columns) - 1)
+
+        headers = self._ocr_cells(cells[0][1:], self.TEXT_CONFIG)
+        column_names = ['Paramètres'] + [self._column_name(header) for header in headers]
+        if not {'Théo', 'Pré', '% Théo'} <= set(column_names):
+            return None
+        column_texts = [self._ocr_cells([row[column] for row in cells[1:]], config)
+                        for column, config in enumerate(configs)]
+
+        table = {name: [] for name in ['Paramètres', 'Théo', 'Pré', '% Théo']}
+        for row in range(len(rows) - 1):
+            row_texts = [texts[row] for texts in column_texts]
+            for name, text in zip(column_names, row_texts):
+                # Unnamed extra columns are ignored; a repeated header keeps its first column
+                if name in table and len(table[name]) == row:
+                    table[name].append(text)
+        return table
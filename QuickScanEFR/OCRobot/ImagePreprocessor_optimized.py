@@ -5,24 +5,118 @@ from concurrent.futures import ProcessPoolExecutor
 
 
 class ImagePreprocessor:
-    def __init__(self, folder_path):
+    # Table band of the report template as fractions of the page height,
+    # i.e. rows 1750*2:3400*2 of an A4 page rendered at 200 dpi and upscaled 4x
+    TABLE_BAND = (0.3742, 0.7269)
+    # Resolution the crop is OCR'd at (200 dpi upscaled 4x)
+    TARGET_DPI = 800
+    UPSCALE = 4
+    # Rows of the table band in the upscaled page
+    CROP_ROWS = (1750*2, 3400*2)
+    THRESHOLD = 100
+    THRESHOLD_MAX = 400
+    KERNEL_SIZE = 5
+    # Preprocessing profiles as (upscale, erosion): 'full' is the usual treatment,
+    # 'fast' the cheap first pass of the adaptive OCR
+    PROFILES = {'fast': (2, False), 'full': (UPSCALE, True)}
+    # Table detection: ruling lines are runs of ink at least this fraction of the page
+    # width (or height) long, and the grid must cover this fraction of the page
+    LINE_FRACTION = 1 / 30
+    MIN_TABLE_AREA = 0.05
+    TABLE_MARGIN = 10
+
+    def __init__(self, folder_path, max_workers=None, detect_table=False, mp_context=None):
         self.folder_path = folder_path
         self.output_folder = os.path.join(folder_path)
+        self.max_workers = max_workers
+        # mp_context: multiprocessing context of the process pool (None: the platform default)
+        self.mp_context = mp_context
+        # detect_table: crop to the detected results grid instead of the fixed CROP_ROWS
+        self.detect_table = detect_table
 
-    def _preprocess_image(self, image_path):
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        image = cv2.resize(image, None, fx=4, fy=4,
+    def _binarize(self, image, erode=True):
+        _, image = cv2.threshold(image, self.THRESHOLD, self.THRESHOLD_MAX, cv2.THRESH_BINARY)
+        if not erode:
+            return image
+        kernel = np.ones((self.KERNEL_SIZE, self.KERNEL_SIZE), np.uint8)  # A 5x5 kernel of ones
+        return cv2.erode(image, kernel, iterations=1)
+
+    def locate_table(self, image):
+        """
+        Finds the results grid of a grayscale page from its ruling lines.
+
+        Horizontal and vertical lines are kept by morphological openings with
+        long thin kernels, and the largest bounding box of the resulting grid
+        is taken as the table.
+
+        Returns:
+            tuple: (top, bottom, left, right) in pixels of the given page, or None
+            when no grid large enough is found.
+        """
+        height, width = image.shape
+        ink = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+        horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (max(1, int(width * self.LINE_FRACTION)), 1)))
+        vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, cv2.getStructuringElement(
+            cv2.MORPH_RECT, (1, max(1, int(height * self.LINE_FRACTION)))))
+        # Joins the lines of a grid whose strokes do not quite touch
+        grid = cv2.dilate(horizontal | vertical, np.ones((3, 3), np.uint8), iterations=2)
+        contours, _ = cv2.findContours(grid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        boxes = [cv2.boundingRect(contour) for contour in contours]
+        boxes = [box for box in boxes if box[2] * box[3] >= self.MIN_TABLE_AREA * width * height]
+        if not boxes:
+            return None
+        x, y, w, h = max(boxes, key=lambda box: box[2] * box[3])
+        margin = self.TABLE_MARGIN
+        return max(0, y - margin), min(height, y + h + margin), max(0, x - margin), min(width, x + w + margin)
+
+    def preprocess(self, image, profile='full'):
+        # Grayscale page in, binarized table band out
+        upscale, erode = self.PROFILES[profile]
+        if self.detect_table:
+            box = self.locate_table(image)
+            if box is not None:
+                # Cropped before upscaling, so the rest of the page is never resized or thresholded
+                top, bottom, left, right = box
+                image = cv2.resize(image[top:bottom, left:right], None, fx=upscale, fy=upscale,
+                                   interpolation=cv2.INTER_CUBIC)
+                return self._binarize(image, erode)
+            print("No table grid detected, using the template crop")
+        image = cv2.resize(image, None, fx=upscale, fy=upscale,
                            interpolation=cv2.INTER_CUBIC)
-        _, image = cv2.threshold(image, 100, 400, cv2.THRESH_BINARY)
-        kernel = np.ones((5, 5), np.uint8)  # A 5x5 kernel of ones
-        image = cv2.erode(image, kernel, iterations=1)
-        image = image[1750*2:3400*2, 0:-1]
+        image = self._binarize(image, erode)
+        # CROP_ROWS are rows of the page upscaled UPSCALE times
+        top, bottom = (row * upscale // self.UPSCALE for row in self.CROP_ROWS)
+        return image[top:bottom, 0:-1]
 
-        base_name = os.path.splitext(os.path.basename(image_path))[0]
+    def preprocess_band(self, band, profile='full'):
+        # Band already cropped and rendered at TARGET_DPI by poppler: no upscaling,
+        # and only the table area is thresholded and eroded
+        upscale, erode = self.PROFILES[profile]
+        if upscale != self.UPSCALE:
+            # A profile upscaling less than UPSCALE OCRs the band at a lower resolution too
+            scale = upscale / self.UPSCALE
+            band = cv2.resize(band, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self._binarize(band, erode)[:, 0:-1]
+
+    def settings(self):
+        # Everything that shapes the preprocessed crop, e.g. for the OCR cache key
+        return (f"threshold={self.THRESHOLD},{self.THRESHOLD_MAX};kernel={self.KERNEL_SIZE};"
+                f"upscale={self.UPSCALE};profiles={self.PROFILES};crop={self.CROP_ROWS};band={self.TABLE_BAND};dpi={self.TARGET_DPI};"
+                f"detect_table={self.detect_table},{self.LINE_FRACTION},{self.MIN_TABLE_AREA},{self.TABLE_MARGIN}")
+
+    def save_image(self, image, base_name):
         preprocessed_image_path = os.path.join(
             self.output_folder, f'{base_name}.png')
         cv2.imwrite(preprocessed_image_path, image)
-      
+
+    def _preprocess_image(self, image_path):
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+        image = self.preprocess(image)
+
+        base_name = os.path.splitext(os.path.basename(image_path))[0]
+        self.save_image(image, base_name)
+
 
     def process_images_in_folder(self):
         if not os.path.exists(self.output_folder):
@@ -30,7 +124,7 @@ class ImagePreprocessor:
 
         png_files = [file for file in os.listdir(
             self.folder_path) if file.lower().endswith('.png')]
-        with ProcessPoolExecutor() as executor:
+        with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context) as executor:
             results = list(executor.map(self._preprocess_image,
                                         [os.path.join(self.folder_path, png_file) for png_file in png_files]))
 
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import pickle
+import sys
+import time
+from collections import Counter, defaultdict
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from SQLiteStore import SQLiteStore, clear_command, file_hash
+
+
+class JobLedger(SQLiteStore):
+    """
+    Per-document record of how far OCRobot got, so a rerun resumes instead of starting over.
+
+    Each PDF is stored with a fingerprint of its content and of the pipeline
+    settings, the last stage it completed (STAGES, in order) and, once it is
+    in its patient file, the SHA-256 of that file. A document whose fingerprint
+    changed is done again from the start, one whose patient file went missing or
+    was modified since from the stage given by the pipeline. A document that
+    raised is stored as 'failed' with its error and skipped until the file
+    changes.
+    """
+
+    FILENAME = 'ocrobot_jobs.sqlite'
+    TABLE = 'jobs'
+    COLUMNS = ("document TEXT PRIMARY KEY, fingerprint TEXT, stage TEXT, output_hash TEXT, "
+               "error TEXT, tables BLOB, updated REAL")
+    SCHEMA_VERSION = 2
+    # Page xlsx written by the OCR, page xlsx reshaped (staged and in-memory modes) or reshaped
+    # tables kept in the ledger (fused and shared-memory modes), patient file written and formatted
+    STAGES = ('ocr', 'reshaped', 'tables', 'formatted')
+
+    def __init__(self, folder, settings=''):
+        super().__init__(folder)
+        self.settings = settings
+        self._fingerprints = {}
+
+    def fingerprint(self, pdf_path):
+        if pdf_path not in self._fingerprints:
+            self._fingerprints[pdf_path] = hashlib.sha256(
+                f"{file_hash(pdf_path)}|{self.settings}".encode()).hexdigest()
+        return self._fingerprints[pdf_path]
+
+    def stage(self, pdf_path, output_path, restart=None):
+        # Last stage the document completed that still holds, 'failed', or None to start from scratch;
+        # restart: stage a formatted document goes back to when its patient file changed
+        row = self.connection.execute("SELECT fingerprint, stage, output_hash, error FROM jobs WHERE document = ?",
+                                      (os.path.basename(pdf_path),)).fetchone()
+        if row is None or row[0] != self.fingerprint(pdf_path):
+            return None
+        _, stage, output_hash, error = row
+        if stage == 'failed':
+            print(f"Skipping {os.path.basename(pdf_path)}: failed in an earlier run ({error})")
+        elif output_hash is not None and (not os.path.exists(output_path) or file_hash(output_path) != output_hash):
+            print(f"{output_path} changed since {os.path.basename(pdf_path)} was processed")
+            return restart
+        return stage
+
+    def tables(self, pdf_path):
+        # Reshaped tables kept at the 'tables' stage, by page xlsx filename
+        row = self.connection.execute("SELECT tables FROM jobs WHERE document = ?",
+                                      (os.path.basename(pdf_path),)).fetchone()
+        return {} if row is None or row[0] is None else pickle.loads(row[0])
+
+    def record(self, pdf_path, stage, output_path=None, tables=None, error=None):
+        # The tables stored for a document stay until new ones are given or its fingerprint changes
+        output_hash = file_hash(output_path) if output_path and os.path.exists(output_path) else None
+        self.connection.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (document) DO UPDATE SET "
+            "tables = CASE WHEN excluded.tables IS NULL AND fingerprint = excluded.fingerprint "
+            "THEN tables ELSE excluded.tables END, fingerprint = excluded.fingerprint, stage = excluded.stage, "
+            "output_hash = excluded.output_hash, error = excluded.error, updated = excluded.updated",
+            (os.path.basename(pdf_path), self.fingerprint(pdf_path), stage, output_hash, error,
+             None if tables is None else pickle.dumps(tables), time.time()))
+        self.connection.commit()
+
+
+class DocumentProgress:
+    """
+    Pages left per document while a pool works through them.
+
+    The results of a document's pages are handed back together once its last
+    page is done, so the document can be recorded right away. A page that
+    raised fails its whole document: the error is printed and recorded in the
+    ledger, and the other documents carry on.
+    """
+
+    def __init__(self, ledger=None, cleanup=None):
+        # cleanup: function of a pdf path removing the files its failed document left behind
+        self.ledger = ledger
+        self.cleanup = cleanup
+        self.pages_left = Counter()
+        self.results = defaultdict(list)
+        self.failed = {}
+
+    def expect(self, pdf_paths):
+        # One entry per page about to be submitted
+        self.pages_left.update(pdf_paths)
+
+    def page_done(self, pdf_path, result=None, error=None):
+        """
+        Collects one page of a document.
+
+        Returns:
+            list: Results of all the pages of the document once its last page
+            is done, None while pages are left or when the document failed.
+        """
+        self.pages_left[pdf_path] -= 1
+        if error is not None:
+            self.fail(pdf_path, error)
+        if pdf_path in self.failed:
+            return None
+        self.results[pdf_path].append(result)
+        if self.pages_left[pdf_path] > 0:
+            return None
+        return self.results.pop(pdf_path)
+
+    def future_done(self, pdf_path, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            return self.page_done(pdf_path, error=e)
+        return self.page_done(pdf_path, result)
+
+    def fail(self, pdf_path, error):
+        if pdf_path in self.failed:
+            return
+        self.failed[pdf_path] = str(error) or type(error).__name__
+        print(f"Error processing {os.path.basename(pdf_path)}: {self.failed[pdf_path]}")
+        self.results.pop(pdf_path, None)
+        if self.cleanup is not None:
+            self.cleanup(pdf_path)
+        if self.ledger is not None:
+            self.ledger.record(pdf_path, 'failed', error=self.failed[pdf_path])
+
+    def clean_up(self):
+        # Pages still running when their document failed may have written files since
+        if self.cleanup is not None:
+            for pdf_path in self.failed:
+                self.cleanup(pdf_path)
+
+
+# Usage: python JobLedger.py clear <folder>
+if __name__ == "__main__":
+    clear_command(JobLedger)
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from SQLiteStore import SQLiteStore, clear_command
+
+
+class OCRCache(SQLiteStore):
+    """
+    Content-addressed cache of raw Tesseract output, so unchanged pages are not OCR'd again.
+
+    Entries are keyed by the SHA-256 of the preprocessed image pixels plus the
+    preprocessing and Tesseract settings. Once the stored text goes over
+    max_bytes, the least recently used entries are evicted. The cache travels
+    to the pool workers with the pipeline: each process opens its own connection.
+    Hits update last_used by batches of TOUCH_EVERY, so a worker that exits
+    may leave its last few hits unrecorded, which only makes the eviction
+    order slightly stale.
+    """
+
+    FILENAME = 'ocr_cache.sqlite'
+    TABLE = 'ocr_texts'
+    COLUMNS = "key TEXT PRIMARY KEY, text TEXT, size INTEGER, last_used REAL"
+    INDEXES = (('ocr_texts_last_used', 'last_used'),)
+    # The pool workers read and write the cache at the same time
+    WAL = True
+    # Hits whose last_used is written in a single transaction
+    TOUCH_EVERY = 64
+    # Puts after which the running total is read again, to see what the other processes wrote
+    RESYNC_EVERY = 256
+
+    def __init__(self, folder, settings='', max_bytes=64 * 1024 * 1024):
+        super().__init__(folder)
+        self.settings = settings
+        self.max_bytes = max_bytes
+        # Running size of the stored texts, read from the table when the connection opens
+        self._total = None
+        self._puts = 0
+        # key -> time of the hits whose last_used is not written yet
+        self._touched = {}
+
+    def __getstate__(self):
+        # A worker reads the total on its own connection and records its own hits
+        state = super().__getstate__()
+        state['_total'] = None
+        state['_touched'] = {}
+        return state
+
+    def key(self, image, tesseract_config=''):
+        digest = hashlib.sha256()
+        digest.update(f"{image.shape}{image.dtype}".encode())
+        digest.update(image.tobytes())
+        digest.update(f"|{self.settings}|{tesseract_config}".encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT text FROM ocr_texts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        # last_used is written by batches of TOUCH_EVERY hits rather than one commit per hit
+        self._touched[key] = time.time()
+        if len(self._touched) >= self.TOUCH_EVERY:
+            self._flush_touched()
+            self.connection.commit()
+        return row[0]
+
+    def _flush_touched(self):
+        self.connection.executemany("UPDATE ocr_texts SET last_used = ? WHERE key = ?",
+                                    [(used, key) for key, used in self._touched.items()])
+        self._touched = {}
+
+    def _read_total(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_texts").fetchone()[0]
+
+    def put(self, key, text):
+        size = len(text.encode('utf-8'))
+        if self._total is None or self._puts >= self.RESYNC_EVERY:
+            self._total = self._read_total()
+            self._puts = 0
+        # Another worker may have stored the same crop in the meantime
+        replaced = self.connection.execute("SELECT size FROM ocr_texts WHERE key = ?", (key,)).fetchone()
+        self.connection.execute("INSERT OR REPLACE INTO ocr_texts VALUES (?, ?, ?, ?)",
+                                (key, text, size, time.time()))
+        self._total += size - (replaced[0] if replaced else 0)
+        self._puts += 1
+        # Pending hits first, so the eviction order is up to date
+        self._flush_touched()
+        if self._total > self.max_bytes:
+            # The other processes' writes count too: the total is read again before evicting
+            self._total = self._read_total()
+            self._puts = 0
+            if self._total > self.max_bytes:
+                self._evict(self._total - self.max_bytes)
+        self.connection.commit()
+
+    def _evict(self, excess):
+        # Least recently used first, until the cache fits in max_bytes again
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM ocr_texts ORDER BY last_used"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self._total -= size
+        self.connection.executemany("DELETE FROM ocr_texts WHERE key = ?", evicted)
+
+    def clear(self):
+        removed = super().clear()
+        self.connection.execute("VACUUM")
+        self._total = 0
+        self._touched = {}
+        return removed
+
+    def close(self):
+        if self._connection is not None and self._touched:
+            self._flush_touched()
+        super().close()
+        self._total = None
+
+
+# Usage: python OCRCache.py clear <folder>
+if __name__ == "__main__":
+    clear_command(OCRCache)
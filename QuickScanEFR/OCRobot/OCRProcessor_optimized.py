@@ -1,10 +1,24 @@
+import csv
+import io
+import json
 import os
+import tempfile
+import time
 import cv2
+import numpy as np
 import pytesseract
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from GridCellExtractor import GridCellExtractor
 pytesseract.pytesseract.tesseract_cmd = r'C:\Users\benysar\AppData\Local\Programs\Tesseract-OCR\tesseract.exe'
 
 
+def limit_tesseract_threads(threads):
+    # Tesseract's OpenMP build starts one thread per core in every process it runs;
+    # with one Tesseract per worker, those threads would oversubscribe the cores.
+    # Used as the initializer of the process pools that call pytesseract.
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)
+
 
 class TextExtractorFromImages:
 
@@ -24,36 +38,143 @@ class TextExtractorFromImages:
     PERC_THEO_KEYWORDS = set(
         ['%Théo', '% Théo', "%Theo", "% Theo", '*Théo', '* Théo', "*Theo", "* Theo", '‘* Theo'])
 
-    def __init__(self, folder_path):
+    # Passed to every Tesseract run, and part of the OCR cache key
+    TESSERACT_CONFIG = ''
+    # Layout mode: words whose centers are closer than this fraction of the median word
+    # height vertically are on the same table row
+    ROW_GAP = 0.5
+    PERC_PREFIXES = ('%', '*', '‘*')
+    # Adaptive mode: a page read with the fast profile is kept when the mean word
+    # confidence reaches this and the table is well formed
+    MIN_CONFIDENCE = 80
+
+    def __init__(self, folder_path, max_workers=None, threads_per_worker=1, batch_size=1, cache=None,
+                 layout=False, grid=False, adaptive=False, mp_context=None):
         self.folder_path = folder_path
+        # max_workers: Tesseract processes run at once (None: one per core, 1: serial)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # mp_context: multiprocessing context of the process pool (None: the platform default)
+        self.mp_context = mp_context
+        # threads_per_worker: OMP_THREAD_LIMIT given to each Tesseract in parallel mode
+        self.threads_per_worker = threads_per_worker
+        # batch_size: PNGs OCR'd by a single Tesseract run, so the engine starts once per batch
+        self.batch_size = max(1, batch_size)
+        # cache: OCRCache of the raw Tesseract output, or None to always run Tesseract
+        self.cache = cache
+        # layout: build the table from the word boxes of image_to_data instead of keyword splitting
+        self.layout = layout
+        # grid: OCR the cells of a ruled table one by one (falls back to the other modes without a grid)
+        self.grid_extractor = GridCellExtractor(self._ocr_images) if grid else None
+        # adaptive: cheap preprocessing first, the full one only for doubtful pages (process_page_adaptive)
+        self.adaptive = adaptive
+
+    def _tesseract_settings(self):
+        return f"tesseract {pytesseract.get_tesseract_version()}|{self.TESSERACT_CONFIG}"
+
+    def _cached_ocr(self, image, kind, ocr):
+        # kind tells apart the outputs cached for the same image ('' for the plain text)
+        if self.cache is None:
+            return ocr(image)
+        key = self.cache.key(image, self._tesseract_settings() + (f'|{kind}' if kind else ''))
+        text = self.cache.get(key)
+        if text is None:
+            text = ocr(image)
+            self.cache.put(key, text)
+        return text
+
+    def _image_to_string(self, image, tsv=False):
+        # tsv: word table of image_to_data instead of the plain text
+        ocr = pytesseract.image_to_data if tsv else pytesseract.image_to_string
+        return self._cached_ocr(image, 'tsv' if tsv else '',
+                                lambda image: ocr(image, config=self.TESSERACT_CONFIG))
 
-    def _extract_text_from_image(self, image_path):
+    def _extract_text_from_image(self, image_path, tsv=False):
         image = cv2.imread(image_path)
-        return pytesseract.image_to_string(image)
+        return self._image_to_string(image, tsv)
+
+    def _extract_texts_from_images(self, image_paths):
+        if self.cache is None:
+            return self._run_batch(image_paths)
+        # Only the images missing from the cache go to Tesseract
+        keys = [self.cache.key(cv2.imread(path), self._tesseract_settings()) for path in image_paths]
+        texts = [self.cache.get(key) for key in keys]
+        missing = [i for i, text in enumerate(texts) if text is None]
+        if missing:
+            for i, text in zip(missing, self._run_batch([image_paths[i] for i in missing])):
+                texts[i] = text
+                self.cache.put(keys[i], text)
+        return texts
+
+    def _run_batch(self, image_paths, config=None):
+        # config: Tesseract options of the run, TESSERACT_CONFIG by default
+        if config is None:
+            config = self.TESSERACT_CONFIG
+        if len(image_paths) == 1:
+            return [pytesseract.image_to_string(cv2.imread(image_paths[0]), config=config)]
+        # Tesseract reads a .txt input as a list of images and OCRs them as the pages
+        # of one document, separated by page_separator (a form feed by default)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            list_path = os.path.join(tmp_dir, 'images.txt')
+            with open(list_path, 'w', encoding='utf-8') as list_file:
+                list_file.write('\n'.join(os.path.abspath(path) for path in image_paths) + '\n')
+            texts = pytesseract.image_to_string(list_path, config=config).split('\f')
+        # Tesseract 4 ends every page with the separator, Tesseract 5 only puts it between pages
+        if len(texts) == len(image_paths) + 1 and not texts[-1].strip():
+            texts.pop()
+        if len(texts) != len(image_paths):
+            print(f"Batch OCR returned {len(texts)} pages for {len(image_paths)} images, "
+                  f"falling back to one Tesseract run per image")
+            return [pytesseract.image_to_string(cv2.imread(path), config=config)
+                    for path in image_paths]
+        return texts
+
+    def _ocr_images(self, images, config):
+        # Arrays OCR'd in one Tesseract run, through PNGs of a temporary folder (GridCellExtractor)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_paths = [os.path.join(tmp_dir, f'{i}.png') for i in range(len(images))]
+            for image_path, image in zip(image_paths, images):
+                cv2.imwrite(image_path, image)
+            return self._run_batch(image_paths, config)
+
+    def _extract_grid(self, image):
+        # The whole table is cached as JSON under the crop and the grid settings ('null' when
+        # there is no grid)
+        table = json.loads(self._cached_ocr(
+            image, f'grid;{self.grid_extractor.settings()}',
+            lambda image: json.dumps(self.grid_extractor.extract(image))))
+        return None if table is None else self._cut_at_end(table)
+
+    def process_image(self, image):
+        # Same as _process_file for an image already in memory (NumPy array)
+        if self.grid_extractor is not None:
+            table = self._extract_grid(image)
+            if table is not None:
+                return table
+        if self.layout:
+            return self._parse_layout(self._image_to_string(image, tsv=True))
+        return self._parse_text(self._image_to_string(image))
 
-    def _combine_occurrences(self, sections):
+    def _tokenize(self, text):
+        # One pass over Tesseract's words: the COMBINE_PAIRS are merged as they come and
+        # the first position of every token is kept to cut the sections without rescanning
+        words = text.split()
+        tokens = []
+        first_index = {}
         i = 0
-        while i < len(sections) - 1:
-            pair = (sections[i], sections[i+1])
-            if pair in self.COMBINE_PAIRS:
-                sections[i] = " ".join(pair)
-                sections.pop(i + 1)
-            else:
+        while i < len(words):
+            token = words[i]
+            if i + 1 < len(words) and (token, words[i + 1]) in self.COMBINE_PAIRS:
+                token = f"{token} {words[i + 1]}"
                 i += 1
-        return sections
+            first_index.setdefault(token, len(tokens))
+            tokens.append(token)
+            i += 1
+        return tokens, first_index
 
-    def _extract_section(self, sections, start_keywords=None, end_keywords=None, end_offset=0):
-        if start_keywords:
-            start_idx = next((sections.index(
-                keyword) + 1 for keyword in start_keywords if keyword in sections), 0)
-        else:
-            start_idx = 0
-        if end_keywords:
-            end_idx = next((sections.index(
-                keyword) + end_offset for keyword in end_keywords if keyword in sections), len(sections))
-        else:
-            end_idx = len(sections)
-        return [item for item in sections[start_idx:end_idx] if item]
+    @staticmethod
+    def _boundary(first_index, keywords, offset, default):
+        # Position of the first keyword of the set found in the text, as sections.index() gave it
+        return next((first_index[keyword] + offset for keyword in keywords if keyword in first_index), default)
 
     def _adjust_list_length(self, target_list, reference_list):
         target_list = ["", ""] + target_list
@@ -62,21 +183,24 @@ class TextExtractorFromImages:
         return target_list
 
     def _process_file(self, image_path):
-        text = self._extract_text_from_image(image_path)
-        sections = text.split()
-
-        sections_set = set(sections)
-        end_keyword = ['VIMS'] if 'VIMS' in sections_set else ['DEM25']
-
-        sections = self._combine_occurrences(sections)
-        parameters_section = self._extract_section(
-            sections, None, end_keyword, 1)
-        theo_values = self._extract_section(
-            sections, self.THEO_KEYWORDS, self.PRE_KEYWORDS)
-        pre_values = self._extract_section(
-            sections, self.PRE_KEYWORDS, self.PERC_THEO_KEYWORDS)
-        perc_theo_values = self._extract_section(
-            sections, self.PERC_THEO_KEYWORDS)
+        if self.grid_extractor is not None:
+            table = self._extract_grid(cv2.imread(image_path, cv2.IMREAD_GRAYSCALE))
+            if table is not None:
+                return table
+        if self.layout:
+            return self._parse_layout(self._extract_text_from_image(image_path, tsv=True))
+        return self._parse_text(self._extract_text_from_image(image_path))
+
+    def _parse_text(self, text):
+        tokens, first_index = self._tokenize(text)
+        end_keyword = ['VIMS'] if 'VIMS' in first_index else ['DEM25']
+
+        parameters_section = tokens[:self._boundary(first_index, end_keyword, 1, len(tokens))]
+        theo_values = tokens[self._boundary(first_index, self.THEO_KEYWORDS, 1, 0):
+                             self._boundary(first_index, self.PRE_KEYWORDS, 0, len(tokens))]
+        pre_values = tokens[self._boundary(first_index, self.PRE_KEYWORDS, 1, 0):
+                            self._boundary(first_index, self.PERC_THEO_KEYWORDS, 0, len(tokens))]
+        perc_theo_values = tokens[self._boundary(first_index, self.PERC_THEO_KEYWORDS, 1, 0):]
 
         theo_values = self._adjust_list_length(theo_values, parameters_section)
         perc_theo_values = self._adjust_list_length(
@@ -91,21 +215,185 @@ class TextExtractorFromImages:
 
         return df_data
 
-    def process_texts_in_folder(self):
-        files = os.listdir(self.folder_path)
-        png_files = [file for file in files if file.lower().endswith('.png')]
+    @staticmethod
+    def _read_words(tsv):
+        # Recognized words of image_to_data's TSV, without the layout-only rows
+        words = pd.read_csv(io.StringIO(tsv), sep='\t', quoting=csv.QUOTE_NONE,
+                            dtype={'text': str}, keep_default_na=False)
+        return words[(words['conf'].astype(float) >= 0) & (words['text'].str.strip() != '')]
+
+    @staticmethod
+    def _well_formed(table):
+        # Columns of the same length, as the DataFrame needs, and a date marker for the reshape
+        return len({len(values) for values in table.values()}) == 1 and 'Date test' in table['Paramètres']
+
+    def usable_table(self, table, name):
+        # Pages without a results table (blank pages, annexes...) give columns of unequal
+        # length or nothing to reshape: they are logged and skipped instead of failing the run
+        if self._well_formed(table):
+            return True
+        print(f"Skipping {name}: no results table found")
+        return False
+
+    def process_page_adaptive(self, page, preprocess):
+        """
+        OCRs a grayscale page with the fast preprocessing profile, and again with
+        the full one only if the first result is doubtful.
+
+        The fast pass reads the words and their confidences from a single
+        image_to_data call. The page is escalated when the mean confidence is
+        below MIN_CONFIDENCE or the table is not well formed.
 
-        dfs = []
-        for png_file in png_files:
-            file_path = os.path.join(self.folder_path, png_file)
-            df_data = self._process_file(file_path)
-            
-            df = pd.DataFrame(df_data)
-            dfs.append(df)
-            
+        Args:
+            page: Grayscale page as rendered.
+            preprocess: Function (page, profile) -> preprocessed image.
+
+        Returns:
+            tuple: (table, preprocessed image kept, escalated).
+        """
+        image = preprocess(page, 'fast')
+        tsv = self._image_to_string(image, tsv=True)
+        words = self._read_words(tsv)
+        confidence = words['conf'].astype(float).mean() if len(words) else 0
+        table = self._parse_layout(tsv) if self.layout else self._parse_text(' '.join(words['text']))
+        if confidence >= self.MIN_CONFIDENCE and self._well_formed(table):
+            return table, image, False
+        image = preprocess(page, 'full')
+        return self.process_image(image), image, True
+
+    def _parse_layout(self, tsv):
+        """
+        Builds the table from Tesseract's word boxes (image_to_data TSV output).
+
+        Words are grouped into rows by their vertical centers and into columns
+        by the nearest header among Théo, Pré and % Théo, the parameter names
+        being left of the first one. Every row below the headers gives one line
+        of each column, so the columns always have the same length. Falls back
+        to keyword splitting when the headers are not found.
+
+        Returns:
+            dict: Same columns as _parse_text.
+        """
+        words = self._read_words(tsv)
+        if words.empty:
+            return self._parse_text('')
+        fallback_text = ' '.join(words['text'])
+
+        # Rows: a new row starts wherever the sorted vertical centers jump
+        center_y = (words['top'] + words['height'] / 2).to_numpy()
+        order = np.argsort(center_y, kind='stable')
+        new_row = np.diff(center_y[order]) > self.ROW_GAP * np.median(words['height'])
+        rows = np.empty(len(words), dtype=int)
+        rows[order] = np.concatenate(([0], np.cumsum(new_row)))
+        words = words.assign(row=rows, center_x=words['left'] + words['width'] / 2)
+        words = words.sort_values(['row', 'left'])
+
+        # Headers: "% Théo" may come as one word or as "%" followed by "Théo" on the same row
+        text = words['text'].str.strip()
+        previous = text.shift().where(words['row'] == words['row'].shift(), '')
+        is_theo = text.isin(self.THEO_KEYWORDS)
+        is_perc = text.isin(self.PERC_THEO_KEYWORDS) | (is_theo & previous.isin(self.PERC_PREFIXES))
+        headers = {
+            'Théo': words[is_theo & ~is_perc],
+            'Pré': words[text.isin(self.PRE_KEYWORDS)],
+            '% Théo': words[is_perc],
+        }
+        if any(header.empty for header in headers.values()):
+            print("Table headers not found in the OCR layout, falling back to keyword splitting")
+            return self._parse_text(fallback_text)
+        header_row = headers['Pré']['row'].iloc[0]
+        centers = sorted((header['center_x'].iloc[0], name) for name, header in headers.items())
+
+        # Columns: split at the midpoints between header centers, the parameters on the left
+        x_centers = np.array([center for center, _ in centers])
+        edges = np.concatenate(([x_centers[0] - (x_centers[1] - x_centers[0]) / 2],
+                                (x_centers[:-1] + x_centers[1:]) / 2))
+        column_names = ['Paramètres'] + [name for _, name in centers]
+        cells = words[words['row'] > header_row]
+        cells = cells.assign(column=np.searchsorted(edges, cells['center_x'].to_numpy()))
+        table = (cells.groupby(['row', 'column'])['text'].agg(' '.join)
+                 .unstack(fill_value='')
+                 .reindex(columns=range(len(column_names)), fill_value=''))
+        table.columns = column_names
+        return self._cut_at_end({column: table[column].tolist()
+                                 for column in ['Paramètres', 'Théo', 'Pré', '% Théo']})
+
+    @staticmethod
+    def _cut_at_end(table):
+        # Same end of table as the keyword parser: the VIMS row, or DEM25 without it
+        parameters = table['Paramètres']
+        end_keyword = 'VIMS' if 'VIMS' in parameters else 'DEM25'
+        if end_keyword not in parameters:
+            return table
+        end = parameters.index(end_keyword) + 1
+        return {column: values[:end] for column, values in table.items()}
+
+    def _process_png_batch(self, png_files):
+        # OCR a batch of PNGs of the folder, one xlsx per PNG; returns the time spent per image
+        start_time = time.time()
+        file_paths = [os.path.join(self.folder_path, png_file) for png_file in png_files]
+        if self.layout or self.grid_extractor is not None:
+            # The word tables and grids are read one image at a time
+            tables = [self._process_file(file_path) for file_path in file_paths]
+        else:
+            tables = [self._parse_text(text) for text in self._extract_texts_from_images(file_paths)]
+        for png_file, table in zip(png_files, tables):
             base_name = os.path.splitext(png_file)[0]
+            if not self.usable_table(table, base_name):
+                continue
+            df = pd.DataFrame(table)
+
             excel_filename = os.path.join(self.folder_path, f"{base_name}.xlsx")
             df.to_excel(excel_filename, index=False)
+        return [(time.time() - start_time) / len(png_files)] * len(png_files)
+
+    @staticmethod
+    def _batch_done(batch, result, on_batch):
+        # Durations of a finished batch; with on_batch, it is called as on_batch(png_files, error)
+        # and a batch that raised is handed over instead of stopping the other batches
+        try:
+            durations = result()
+        except Exception as e:
+            if on_batch is None:
+                raise
+            on_batch(batch, e)
+            return []
+        if on_batch is not None:
+            on_batch(batch, None)
+        return durations
+
+    def process_texts_in_folder(self, on_batch=None):
+        # on_batch: called in this process as each batch is done, in completion order
+        files = os.listdir(self.folder_path)
+        png_files = [file for file in files if file.lower().endswith('.png')]
+
+        batches = [png_files[i:i + self.batch_size]
+                   for i in range(0, len(png_files), self.batch_size)]
+
+        start_time = time.time()
+        durations = []
+        if self.max_workers == 1 or len(batches) < 2:
+            for batch in batches:
+                durations += self._batch_done(batch, lambda: self._process_png_batch(batch), on_batch)
+        else:
+            with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context,
+                                     initializer=limit_tesseract_threads,
+                                     initargs=(self.threads_per_worker,)) as executor:
+                futures = {executor.submit(self._process_png_batch, batch): batch for batch in batches}
+                for future in as_completed(futures):
+                    durations += self._batch_done(futures[future], future.result, on_batch)
+        self._report(durations, time.time() - start_time)
+
+    def _report(self, durations, wall_time, workers=None, batch_size=None):
+        # workers and batch_size: of the pool that OCR'd the images, max_workers and batch_size by default
+        if not durations:
+            return
+        # The serial time is estimated as the sum of the per-image times
+        serial_time = sum(durations)
+        print(f"OCR: {len(durations)} images in {wall_time:.2f} s with {workers or self.max_workers} worker(s) "
+              f"and batches of {batch_size or self.batch_size}, "
+              f"{len(durations) / wall_time:.2f} images/s, {serial_time / len(durations):.2f} s per image, "
+              f"speedup over serial x{serial_time / wall_time:.2f}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory
+
+
+class PageBufferPool:
+    """
+    Fixed set of shared-memory blocks that rendered pages travel in between processes.
+
+    The parent process owns the blocks and hands their names out: a renderer
+    writes a grayscale page into a free block, the OCR worker maps the same
+    block as a NumPy array, and the block goes back to the pool once the page
+    is OCR'd. The number of pages in flight, and so the memory used, is capped
+    by the number of blocks.
+    """
+
+    # An A4 page at 200 dpi is 1654x2339 pixels (3.9 MB); leaves room for larger formats
+    BLOCK_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, block_count, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = [shared_memory.SharedMemory(create=True, size=block_size) for _ in range(block_count)]
+        self.free = deque(block.name for block in self.blocks)
+
+    def acquire(self):
+        # Name of a free block, or None when every block holds a page
+        return self.free.popleft() if self.free else None
+
+    def release(self, name):
+        self.free.append(name)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _attach(name):
+    # Pool workers share the parent's resource tracker (none on Windows), so attaching
+    # does not hand the block over: it is unlinked once, by the pool
+    return shared_memory.SharedMemory(name=name)
+
+
+def write_page(name, image):
+    # Copies a grayscale page into the block; False if it does not fit
+    block = _attach(name)
+    try:
+        if image.nbytes > block.size:
+            return False
+        np.ndarray(image.shape, dtype=np.uint8, buffer=block.buf)[:] = image
+        return True
+    finally:
+        block.close()
+
+
+def read_page(name, shape, function):
+    # Calls function on the page mapped in place, without copying it; the result
+    # must not keep a view of the block, which is unmapped on return
+    block = _attach(name)
+    try:
+        image = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+        result = function(image)
+        del image
+        return result
+    finally:
+        block.close()
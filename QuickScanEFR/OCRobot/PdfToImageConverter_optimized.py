@@ -1,31 +1,112 @@
 import os
+import re
+import subprocess
+import numpy as np
 from pdf2image import convert_from_path
+from pypdf import PdfReader
 from concurrent.futures import ProcessPoolExecutor
 
 
 class PdfConverter:
-    def __init__(self, folder_path):
+    POPPLER_PATH = r"C:\Users\benysar\Desktop\Github\OCR_EFR\packages\poppler-21.11.0\Library\bin"
+
+    # pdf2image's default resolution, which the preprocessing crop was tuned at
+    DPI = 200
+
+    def __init__(self, folder_path, max_workers=None, direct_gray=True, mp_context=None):
         self.folder_path = folder_path
         self.output_folder = os.path.join(folder_path)
+        self.max_workers = max_workers
+        # mp_context: multiprocessing context of the process pool (None: the platform default)
+        self.mp_context = mp_context
+        # direct_gray: in-memory pages come from pdftoppm as grayscale PGM, without an RGB decode
+        self.direct_gray = direct_gray
+
+    def page_count(self, pdf_path):
+        try:
+            with open(pdf_path, 'rb') as pdf_file:
+                return len(PdfReader(pdf_file).pages)
+        except Exception as e:
+            # Left to poppler, which renders what it can of the first page
+            print(f"Could not count the pages of {pdf_path}: {e}")
+            return 1
 
-    def convert_pdf_to_image(self, pdf_path, output_folder):
+    def page_tasks(self, pdf_paths, all_pages=True):
+        # (pdf_path, page) pairs, so a pool spreads the pages of long documents over its workers
+        return [(pdf_path, page) for pdf_path in pdf_paths
+                for page in (range(1, self.page_count(pdf_path) + 1) if all_pages else [1])]
+
+    def convert_pdf_to_image(self, pdf_path, output_folder, pages=None):
         base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
-        images = convert_from_path(pdf_path, first_page=1, last_page=1, poppler_path = r"C:\Users\benysar\Desktop\Github\OCR_EFR\packages\poppler-21.11.0\Library\bin")
-        for i, image in enumerate(images):
-            image_path = os.path.join(output_folder, f'{base_name}{i}.png')
-            image.save(image_path, 'PNG')
+        # 1-based pages to render (the first one by default), saved as {base_name}{page - 1}.png
+        for page in pages or [1]:
+            images = convert_from_path(pdf_path, first_page=page, last_page=page, poppler_path=self.POPPLER_PATH)
+            for image in images:
+                image_path = os.path.join(output_folder, f'{base_name}{page - 1}.png')
+                image.save(image_path, 'PNG')
+
+    def render_pdf(self, pdf_path, pages=None):
+        # Same pages as convert_pdf_to_image, kept in memory as (page, grayscale array) pairs
+        if self.direct_gray:
+            return [(page, self.render_page(pdf_path, page)) for page in pages or [1]]
+        rendered_pages = []
+        for page in pages or [1]:
+            images = convert_from_path(pdf_path, first_page=page, last_page=page, poppler_path=self.POPPLER_PATH)
+            for image in images:
+                rendered_pages.append((page, np.asarray(image.convert('L'))))
+        return rendered_pages
+
+    def _pdftoppm(self, pdf_path, page, dpi, *options):
+        command = [os.path.join(self.POPPLER_PATH, 'pdftoppm'),
+                   '-f', str(page), '-l', str(page), '-r', str(dpi), '-gray', *options, pdf_path]
+        # Without an output root, pdftoppm writes the PGM image to stdout
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+        return self._parse_pgm(output)
+
+    def render_page(self, pdf_path, page=1, dpi=DPI):
+        # Grayscale page read straight from pdftoppm's uncompressed PGM output
+        return self._pdftoppm(pdf_path, page, dpi)
+
+    def render_band(self, pdf_path, page, dpi, top, bottom):
+        """
+        Renders only a horizontal band of a page, in grayscale, straight at the requested resolution.
+
+        top and bottom are fractions of the page height. pdftoppm crops while
+        rendering, so the rest of the page is never rasterized.
+        """
+        with open(pdf_path, 'rb') as pdf_file:
+            pdf_page = PdfReader(pdf_file).pages[page - 1]
+            width, height = float(pdf_page.mediabox.width), float(pdf_page.mediabox.height)
+            if pdf_page.rotation % 180:
+                width, height = height, width
+        scale = dpi / 72
+        return self._pdftoppm(pdf_path, page, dpi,
+                              '-x', '0', '-y', str(round(top * height * scale)),
+                              '-W', str(round(width * scale)), '-H', str(round((bottom - top) * height * scale)))
+
+    @staticmethod
+    def _parse_pgm(data):
+        header = re.match(rb"P5\s+(\d+)\s+(\d+)\s+(\d+)\s", data)
+        if header is None:
+            raise ValueError("pdftoppm did not return a PGM image")
+        width, height = int(header.group(1)), int(header.group(2))
+        return np.frombuffer(data, dtype=np.uint8, count=width * height,
+                             offset=header.end()).reshape(height, width)
 
-    def convert_pdfs_to_images(self):
+    def convert_pdfs_to_images(self, all_pages=False):
         if not os.path.exists(self.output_folder):
             os.makedirs(self.output_folder)
 
         pdf_files = [file for file in os.listdir(
             self.folder_path) if file.lower().endswith('.pdf')]
-        with ProcessPoolExecutor() as executor:
+        # One task per page: a long document does not keep a single worker busy
+        tasks = self.page_tasks([os.path.join(self.folder_path, pdf_file)
+                                 for pdf_file in pdf_files], all_pages)
+        with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context) as executor:
             results = list(executor.map(self.convert_pdf_to_image,
-                                        [os.path.join(self.folder_path, pdf_file)
-                                         for pdf_file in pdf_files],
-                                        [self.output_folder]*len(pdf_files)))
+                                        [pdf_path for pdf_path, _ in tasks],
+                                        [self.output_folder]*len(tasks),
+                                        [[page] for _, page in tasks]))
 
 
 if __name__ == "__main__":
@@ -1,19 +1,85 @@
 import os
 import time
 import pandas as pd
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from PdfToImageConverter_optimized import PdfConverter
 from ImagePreprocessor_optimized import ImagePreprocessor
-from OCRProcessor_optimized import TextExtractorFromImages
-from ExcelFormatter import DataReshaper
+from OCRProcessor_optimized import TextExtractorFromImages, limit_tesseract_threads
+from OCRCache import OCRCache
+from JobLedger import DocumentProgress, JobLedger
+from PageBufferPool import PageBufferPool, read_page, write_page
+from ExcelFormatter import DataReshaper, as_read_from_excel, format_patient_table
 
 
 class MainPipeline:
-    def __init__(self, folder_path):
+    # A preprocessed crop, like a band rendered at 800 dpi (crop_first), is about 6611x3300 pixels (21 MB)
+    CROP_BLOCK_SIZE = 24 * 1024 * 1024
+
+    def __init__(self, folder_path, max_workers=None, in_memory=True, debug_png=False, crop_first=False,
+                 fused=False, ocr_batch_size=1, ocr_cache=True, ocr_layout=False, detect_table=False,
+                 ocr_grid=False, all_pages=False, shared_memory=False, adaptive_ocr=False,
+                 stage_workers=None, queue_size=None, resume=True, mp_context=None):
+        # Combinations that would otherwise be ignored without a word
+        staged = not in_memory and not fused and not shared_memory
+        if adaptive_ocr and staged:
+            raise ValueError("adaptive_ocr needs an in-memory mode (in_memory, fused or shared_memory)")
+        if ocr_batch_size > 1 and (not staged or ocr_layout or ocr_grid):
+            raise ValueError("ocr_batch_size > 1 only applies to the staged mode without ocr_layout or ocr_grid")
+        if crop_first and detect_table:
+            raise ValueError("crop_first and detect_table exclude each other: detect_table needs the whole page")
         self.folder_path = folder_path
-        self.pdf_converter = PdfConverter(folder_path)
-        self.image_preprocessor = ImagePreprocessor(os.path.join(folder_path))
+        self.max_workers = max_workers
+        # mp_context: multiprocessing context of every process pool (None: the platform default);
+        # 'spawn' when the pipeline runs in a thread next to others (QuickScanEFR/main.py)
+        self.mp_context = mp_context
+        # in_memory: pages go from poppler to Tesseract as arrays, without intermediate PNGs
+        # debug_png: also write the preprocessed crops to the folder (in_memory mode)
+        self.in_memory = in_memory
+        self.debug_png = debug_png
+        # crop_first: poppler renders only the table band, at the OCR resolution (in_memory mode)
+        self.crop_first = crop_first
+        # fused: one pool task per PDF also reshapes its tables, and the patient files are
+        # built from those DataFrames without intermediate xlsx (implies in_memory)
+        self.fused = fused
+        # shared_memory: pages are rendered and OCR'd by two separate pools and handed over
+        # through a bounded PageBufferPool; the output is built as in fused mode
+        self.shared_memory = shared_memory
+        # stage_workers: (render, preprocess, ocr) process counts of the shared_memory pipeline;
+        # with 0 preprocess workers the OCR workers preprocess their pages (default split of max_workers)
+        # queue_size: pages allowed to wait between two stages of that pipeline (default: one per OCR worker)
+        self.stage_workers = stage_workers
+        self.queue_size = queue_size
+        # all_pages: OCR every page of the reports, not only the first one; pages are
+        # scheduled as separate pool tasks
+        self.all_pages = all_pages
+        # detect_table: crop to the table grid found on each page rather than the template's band
+        # (the whole page is rendered, so not with crop_first)
+        self.detect_table = detect_table
+        # ocr_batch_size: PNGs per Tesseract run when OCR'ing the folder (staged mode, plain text only)
+        # max_workers caps the process pools (None: one process per core)
+        self.pdf_converter = PdfConverter(folder_path, max_workers, mp_context=mp_context)
+        self.image_preprocessor = ImagePreprocessor(
+            os.path.join(folder_path), max_workers, detect_table, mp_context)
+        # ocr_layout: read the table from Tesseract's word boxes rather than by keyword splitting
+        # ocr_grid: OCR ruled tables cell by cell, numeric config for the value columns
+        # adaptive_ocr: fast preprocessing first, the full one only for low-confidence pages
+        # (in-memory modes only, the staged mode OCRs the crops written to disk)
+        # ocr_cache: reuse the Tesseract output of unchanged crops across runs (ocr_cache.sqlite)
+        cache = None
+        if ocr_cache:
+            cache = OCRCache(folder_path, f"{self.image_preprocessor.settings()};crop_first={crop_first}")
         self.text_extractor = TextExtractorFromImages(
-            os.path.join(folder_path))
+            os.path.join(folder_path), max_workers, batch_size=ocr_batch_size, cache=cache,
+            layout=ocr_layout, grid=ocr_grid, adaptive=adaptive_ocr, mp_context=mp_context)
+        # resume: skip the documents already in their patient file and pick the others up at the
+        # stage an earlier run reached (ocrobot_jobs.sqlite)
+        self.ledger = None
+        if resume:
+            self.ledger = JobLedger(folder_path, (
+                f"{self.image_preprocessor.settings()};crop_first={crop_first};all_pages={all_pages};"
+                f"layout={ocr_layout};grid={ocr_grid};adaptive={adaptive_ocr};"
+                f"tables_in_memory={fused or shared_memory}"))
 
     def delete_intermediate_files(self):
         for dirpath, _, filenames in os.walk(self.folder_path, topdown=False):
@@ -21,23 +87,459 @@ class MainPipeline:
                 if filee.endswith('.png'):
                     os.remove(os.path.join(dirpath, filee))
 
-    def reshape_data(self):
+    def pdf_files(self):
+        return [os.path.join(self.folder_path, file) for file in os.listdir(
+            self.folder_path) if file.lower().endswith('.pdf')]
+
+    def page_tasks(self, pdf_paths=None, progress=None):
+        # Pages of the given PDFs, of the whole folder by default; with a DocumentProgress, a PDF
+        # whose pages cannot be counted fails alone and the pages of the others are expected
+        if pdf_paths is None:
+            pdf_paths = self.pdf_files()
+        if progress is None:
+            return self.pdf_converter.page_tasks(pdf_paths, self.all_pages)
+        tasks = []
+        for pdf_path in pdf_paths:
+            try:
+                tasks.extend(self.pdf_converter.page_tasks([pdf_path], self.all_pages))
+            except Exception as e:
+                progress.fail(pdf_path, e)
+        progress.expect(pdf_path for pdf_path, _ in tasks)
+        return tasks
+
+    def collect_pages(self, executor, function, tasks, progress, on_document):
+        # Submits function(pdf_path, page) for each page task and calls on_document(pdf_path, results)
+        # as soon as the last page of a document is done; the queued pages of a failed document
+        # are cancelled
+        futures = {executor.submit(function, pdf_path, page): pdf_path for pdf_path, page in tasks}
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            if future.cancelled():
+                progress.page_done(pdf_path)
+                continue
+            results = progress.future_done(pdf_path, future)
+            if pdf_path in progress.failed:
+                for other, other_path in futures.items():
+                    if other_path == pdf_path:
+                        other.cancel()
+            elif results is not None:
+                on_document(pdf_path, results)
+        progress.clean_up()
+
+    def remove_document_files(self, pdf_path):
+        # Page PNGs and xlsx of a failed document, so they do not end up in its patient file
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0]
+        for filename in os.listdir(self.folder_path):
+            if filename.endswith(('.png', '.xlsx')) and os.path.splitext(filename)[0].rsplit('_', 1)[0] == base_name:
+                os.remove(os.path.join(self.folder_path, filename))
+
+    @staticmethod
+    def patient_id(pdf_path):
+        # Same ID as the page xlsx get grouped by in concatenate_excel_files
+        return os.path.splitext(os.path.basename(pdf_path))[0].split('_')[0]
+
+    def patient_file(self, pdf_path):
+        return os.path.join(self.folder_path, "concatenated", f"{self.patient_id(pdf_path)}.xlsx")
+
+    def pending_documents(self):
+        """
+        PDFs of the folder still to process, with the last stage each completed in an earlier run.
+
+        A patient file is rebuilt from all of the patient's documents, so the
+        finished documents of a patient with an unfinished one are pending too:
+        from their reshaped page xlsx, or from the tables kept in the ledger
+        when the tables are built in memory. Documents that failed in an
+        earlier run are left out until they change.
+
+        Returns:
+            dict: {pdf_path: stage}, stage one of JobLedger.STAGES or None to
+            start from scratch; every PDF with None without a ledger.
+        """
+        if self.ledger is None:
+            return {pdf_path: None for pdf_path in self.pdf_files()}
+        restart = 'tables' if self.fused or self.shared_memory else 'reshaped'
+        stages = {pdf_path: self.ledger.stage(pdf_path, self.patient_file(pdf_path), restart)
+                  for pdf_path in self.pdf_files()}
+        stages = {pdf_path: stage for pdf_path, stage in stages.items() if stage != 'failed'}
+        unfinished = {self.patient_id(pdf_path) for pdf_path, stage in stages.items() if stage != 'formatted'}
+        return {pdf_path: restart if stage == 'formatted' else stage
+                for pdf_path, stage in stages.items() if self.patient_id(pdf_path) in unfinished}
+
+    def patient_documents(self, stages, progress):
+        # {patient ID: pdf paths} of the pending documents that did not fail
+        documents = {}
+        for pdf_path in stages:
+            if pdf_path not in progress.failed:
+                documents.setdefault(self.patient_id(pdf_path), []).append(pdf_path)
+        return documents
+
+    def record_stage(self, pdf_paths, stage):
+        if self.ledger is None:
+            return
+        for pdf_path in pdf_paths:
+            self.ledger.record(pdf_path, stage, self.patient_file(pdf_path) if stage == 'formatted' else None)
+
+    def render_page(self, pdf_path, page=1):
+        if self.crop_first:
+            top, bottom = ImagePreprocessor.TABLE_BAND
+            return self.pdf_converter.render_band(
+                pdf_path, page, ImagePreprocessor.TARGET_DPI, top, bottom)
+        return self.pdf_converter.render_pdf(pdf_path, [page])[0][1]
+
+    def preprocess_page(self, image, profile='full'):
+        if self.crop_first:
+            return self.image_preprocessor.preprocess_band(image, profile)
+        return self.image_preprocessor.preprocess(image, profile)
+
+    def ocr_page(self, pdf_path, page, image, preprocessed=False):
+        # Preprocesses and OCRs a rendered page; returns (table, (escalated, duration)), escalated
+        # telling whether the adaptive OCR had to fall back on the full profile, duration the
+        # time spent preprocessing and OCR'ing the page
+        start_time = time.time()
+        if preprocessed:
+            table, escalated = self.text_extractor.process_image(image), False
+        elif self.text_extractor.adaptive:
+            table, image, escalated = self.text_extractor.process_page_adaptive(image, self.preprocess_page)
+        else:
+            image = self.preprocess_page(image)
+            table, escalated = self.text_extractor.process_image(image), False
+        duration = time.time() - start_time
+        if self.debug_png:
+            base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
+            self.image_preprocessor.save_image(image, f'{base_name}{page - 1}')
+        return table, (escalated, duration)
+
+    def report_pages(self, page_stats, wall_time, workers=None):
+        # OCR throughput of the in-memory pools, as the staged mode reports it, and the pages
+        # the adaptive OCR escalated; page_stats holds the (escalated, duration) of each page
+        self.text_extractor._report([duration for _, duration in page_stats], wall_time,
+                                    workers or self.max_workers or os.cpu_count(), batch_size=1)
+        if self.text_extractor.adaptive:
+            escalations = sum(escalated for escalated, _ in page_stats)
+            print(f"Adaptive OCR: {escalations}/{len(page_stats)} pages escalated to the full profile")
+
+    def convert_and_preprocess_page(self, pdf_path, page=1):
+        # Staged mode: a page is preprocessed by the worker that rendered it,
+        # without waiting for the rest of the folder
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
+        if self.pdf_converter.direct_gray:
+            # The grayscale render goes straight to preprocessing: only the crop is written as PNG
+            image = self.preprocess_page(self.render_page(pdf_path, page))
+            self.image_preprocessor.save_image(image, f'{base_name}{page - 1}')
+            return
+        self.pdf_converter.convert_pdf_to_image(pdf_path, self.folder_path, [page])
+        self.image_preprocessor._preprocess_image(
+            os.path.join(self.folder_path, f'{base_name}{page - 1}.png'))
+
+    def convert_and_preprocess_pages(self, pdf_paths=None, progress=None):
+        if progress is None:
+            progress = DocumentProgress()
+        tasks = self.page_tasks(pdf_paths, progress)
+        with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context) as executor:
+            self.collect_pages(executor, self.convert_and_preprocess_page, tasks, progress,
+                               lambda pdf_path, results: None)
+
+    def ocr_folder(self, progress=None):
+        # Staged mode: OCRs the crops of the folder, each document recorded as soon as its
+        # last crop is done
+        if progress is None:
+            progress = DocumentProgress()
+        documents = {os.path.splitext(os.path.basename(pdf_path))[0]: pdf_path for pdf_path in self.pdf_files()}
+        png_documents = {}
+        for filename in os.listdir(self.folder_path):
+            base_name = os.path.splitext(filename)[0].rsplit('_', 1)[0]
+            if filename.lower().endswith('.png') and base_name in documents:
+                png_documents[filename] = documents[base_name]
+        progress.expect(png_documents.values())
+
+        def on_batch(png_files, error):
+            for png_file in png_files:
+                if png_file in png_documents and progress.page_done(png_documents[png_file],
+                                                                    error=error) is not None:
+                    self.record_stage([png_documents[png_file]], 'ocr')
+
+        self.text_extractor.process_texts_in_folder(on_batch)
+        progress.clean_up()
+
+    def process_pdf_in_memory(self, pdf_path, page=1):
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
+        table, stats = self.ocr_page(pdf_path, page, self.render_page(pdf_path, page))
+        if self.text_extractor.usable_table(table, f'{base_name}{page - 1}'):
+            df = pd.DataFrame(table)
+            excel_filename = os.path.join(self.folder_path, f'{base_name}{page - 1}.xlsx')
+            df.to_excel(excel_filename, index=False)
+        return stats
+
+    def process_pdfs_in_memory(self, pdf_paths=None, progress=None):
+        if progress is None:
+            progress = DocumentProgress()
+        tasks = self.page_tasks(pdf_paths, progress)
+        page_stats = []
+
+        def on_document(pdf_path, stats):
+            self.record_stage([pdf_path], 'ocr')
+            page_stats.extend(stats)
+
+        start_time = time.time()
+        with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context,
+                                 initializer=limit_tesseract_threads,
+                                 initargs=(self.text_extractor.threads_per_worker,)) as executor:
+            self.collect_pages(executor, self.process_pdf_in_memory, tasks, progress, on_document)
+        self.report_pages(page_stats, time.time() - start_time)
+
+    def ocr_and_reshape(self, pdf_path, page, image, preprocessed=False):
+        # OCR and reshape one rendered page; returns (xlsx filename, reshaped DataFrame, stats of
+        # ocr_page), the DataFrame None for a page without a results table
+        base_name = os.path.splitext(os.path.basename(pdf_path))[0] + '_'
+        table, stats = self.ocr_page(pdf_path, page, image, preprocessed)
+        if not self.text_extractor.usable_table(table, f'{base_name}{page - 1}'):
+            return f'{base_name}{page - 1}.xlsx', None, stats
+        df = as_read_from_excel(pd.DataFrame(table))
+        return f'{base_name}{page - 1}.xlsx', DataReshaper(df).reshape(), stats
+
+    def process_pdf_fused(self, pdf_path, page=1):
+        # Render, preprocess, OCR and reshape one page
+        return self.ocr_and_reshape(pdf_path, page, self.render_page(pdf_path, page))
+
+    def keep_document_tables(self, pdf_path, pages, reshaped_tables, page_stats):
+        # Fused and shared-memory modes: the reshaped tables of a finished document, i.e. the
+        # ocr_and_reshape results of its pages, are kept in the ledger so a rerun does not OCR it again
+        tables = {excel_filename: reshaped_df for excel_filename, reshaped_df, _ in pages if reshaped_df is not None}
+        if self.ledger is not None:
+            self.ledger.record(pdf_path, 'tables', tables=tables)
+        reshaped_tables.update(tables)
+        page_stats.extend(stats for _, _, stats in pages)
+
+    def process_pdfs_fused(self, pdf_paths=None, progress=None):
+        if progress is None:
+            progress = DocumentProgress()
+        tasks = self.page_tasks(pdf_paths, progress)
+        reshaped_tables = {}
+        page_stats = []
+        start_time = time.time()
+        with ProcessPoolExecutor(self.max_workers, mp_context=self.mp_context,
+                                 initializer=limit_tesseract_threads,
+                                 initargs=(self.text_extractor.threads_per_worker,)) as executor:
+            # Tables are collected as soon as their document is done, in completion order
+            self.collect_pages(executor, self.process_pdf_fused, tasks, progress,
+                               lambda pdf_path, pages: self.keep_document_tables(
+                                   pdf_path, pages, reshaped_tables, page_stats))
+        self.report_pages(page_stats, time.time() - start_time)
+        return reshaped_tables
+
+    def render_to_buffer(self, pdf_path, page, block_name):
+        # Render worker: the page goes into the shared block; returns (shape, page), the page
+        # itself only when it is too large for the block and has to be pickled instead
+        image = self.render_page(pdf_path, page)
+        return image.shape, None if write_page(block_name, image) else image
+
+    def preprocess_to_buffer(self, page_block, shape, image, crop_block):
+        # Preprocess worker: reads the page from its block and writes the crop to another;
+        # returns (shape, crop) like render_to_buffer
+        if image is None:
+            image = read_page(page_block, shape, self.preprocess_page)
+        else:
+            image = self.preprocess_page(image)
+        return image.shape, None if write_page(crop_block, image) else image
+
+    def ocr_from_buffer(self, pdf_path, page, block_name, shape, image=None, preprocessed=False):
+        # OCR worker: OCRs the page (preprocessing it unless the preprocess stage did) straight
+        # from the shared block
+        if image is None:
+            return read_page(block_name, shape,
+                             lambda image: self.ocr_and_reshape(pdf_path, page, image, preprocessed))
+        return self.ocr_and_reshape(pdf_path, page, image, preprocessed)
+
+    def page_block_size(self):
+        # Rendered pages: the band of crop_first is rendered at the OCR resolution, a whole page
+        # at 200 dpi fits the default block
+        if self.crop_first:
+            return self.CROP_BLOCK_SIZE
+        return PageBufferPool.BLOCK_SIZE
+
+    def worker_split(self):
+        # (render, preprocess, ocr) process counts; by default a quarter of the workers render
+        # and the OCR workers preprocess their own pages
+        if self.stage_workers:
+            render_workers, preprocess_workers, ocr_workers = self.stage_workers
+        else:
+            total_workers = self.max_workers or os.cpu_count() or 1
+            render_workers = max(1, total_workers // 4)
+            preprocess_workers, ocr_workers = 0, max(1, total_workers - render_workers)
+        if self.text_extractor.adaptive:
+            # The adaptive OCR preprocesses the raw page itself, possibly twice
+            preprocess_workers, ocr_workers = 0, ocr_workers + preprocess_workers
+        return render_workers, preprocess_workers, ocr_workers
+
+    @staticmethod
+    def stage_result(future, pdf_path, buffers, block_name, progress):
+        # Result of a render or preprocess task of the shared-memory pipeline; None, with the
+        # page's block released, when the task raised or its document failed meanwhile
+        try:
+            result = future.result()
+        except Exception as e:
+            progress.fail(pdf_path, e)
+        if pdf_path in progress.failed:
+            buffers.release(block_name)
+            progress.page_done(pdf_path)
+            return None
+        return result
+
+    def process_pdfs_shared(self, pdf_paths=None, progress=None):
+        """
+        Streams the pages through render, preprocess and OCR pools, each with its own workers.
+
+        Pages travel between stages in shared-memory blocks: rendered pages in one
+        PageBufferPool, preprocessed crops in another. A stage only takes a page
+        when a block of its output pool is free, and a block is held until the
+        next stage is done with it. So each pool holds at most the pages of its
+        producing workers, queue_size waiting pages and the pages of its consuming
+        workers. When the OCR falls behind, rendering stops, and memory stays flat
+        however many PDFs are queued.
+
+        Returns:
+            dict: Reshaped DataFrames by xlsx filename, as process_pdfs_fused.
+        """
+        if progress is None:
+            progress = DocumentProgress()
+        tasks = deque(self.page_tasks(pdf_paths, progress))
+        render_workers, preprocess_workers, ocr_workers = self.worker_split()
+        queue_size = ocr_workers if self.queue_size is None else self.queue_size
+        consumers = preprocess_workers or ocr_workers
+        crop_blocks = preprocess_workers + queue_size + ocr_workers if preprocess_workers else 0
+        reshaped_tables = {}
+        page_stats = []
+        start_time = time.time()
+        # The preprocess pool starts no process when it gets no task
+        with PageBufferPool(render_workers + queue_size + consumers, self.page_block_size()) as page_buffers, \
+                PageBufferPool(crop_blocks, self.CROP_BLOCK_SIZE) as crop_buffers, \
+                ProcessPoolExecutor(render_workers, mp_context=self.mp_context) as render_pool, \
+                ProcessPoolExecutor(preprocess_workers or 1, mp_context=self.mp_context) as preprocess_pool, \
+                ProcessPoolExecutor(ocr_workers, mp_context=self.mp_context,
+                                    initializer=limit_tesseract_threads,
+                                    initargs=(self.text_extractor.threads_per_worker,)) as ocr_pool:
+            renders, preprocesses, ocrs = {}, {}, {}
+            # Rendered pages waiting for a free crop block
+            rendered = deque()
+            while tasks or rendered or renders or preprocesses or ocrs:
+                while tasks:
+                    if tasks[0][0] in progress.failed:
+                        progress.page_done(tasks.popleft()[0])
+                        continue
+                    page_block = page_buffers.acquire()
+                    if page_block is None:
+                        break
+                    pdf_path, page = tasks.popleft()
+                    future = render_pool.submit(self.render_to_buffer, pdf_path, page, page_block)
+                    renders[future] = (pdf_path, page, page_block)
+                while rendered:
+                    if rendered[0][0] in progress.failed:
+                        pdf_path, _, page_block, _, _ = rendered.popleft()
+                        page_buffers.release(page_block)
+                        progress.page_done(pdf_path)
+                        continue
+                    crop_block = crop_buffers.acquire()
+                    if crop_block is None:
+                        break
+                    pdf_path, page, page_block, shape, image = rendered.popleft()
+                    future = preprocess_pool.submit(self.preprocess_to_buffer, page_block, shape, image, crop_block)
+                    preprocesses[future] = (pdf_path, page, page_block, crop_block)
+                done, _ = wait(list(renders) + list(preprocesses) + list(ocrs), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in renders:
+                        pdf_path, page, page_block = renders.pop(future)
+                        result = self.stage_result(future, pdf_path, page_buffers, page_block, progress)
+                        if result is None:
+                            continue
+                        shape, image = result
+                        if preprocess_workers:
+                            rendered.append((pdf_path, page, page_block, shape, image))
+                        else:
+                            ocrs[ocr_pool.submit(self.ocr_from_buffer, pdf_path, page, page_block,
+                                                 shape, image)] = (pdf_path, page_buffers, page_block)
+                    elif future in preprocesses:
+                        pdf_path, page, page_block, crop_block = preprocesses.pop(future)
+                        page_buffers.release(page_block)
+                        result = self.stage_result(future, pdf_path, crop_buffers, crop_block, progress)
+                        if result is None:
+                            continue
+                        shape, image = result
+                        ocrs[ocr_pool.submit(self.ocr_from_buffer, pdf_path, page, crop_block,
+                                             shape, image, True)] = (pdf_path, crop_buffers, crop_block)
+                    else:
+                        pdf_path, buffers, block_name = ocrs.pop(future)
+                        buffers.release(block_name)
+                        pages = progress.future_done(pdf_path, future)
+                        if pages is not None:
+                            self.keep_document_tables(pdf_path, pages, reshaped_tables, page_stats)
+        self.report_pages(page_stats, time.time() - start_time, ocr_workers)
+        return reshaped_tables
+
+    def write_patient_tables(self, reshaped_tables, documents=None):
+        # In-memory counterpart of concatenate_excel_files and format_excel: the reshaped
+        # tables are grouped by ID and each patient's xlsx is written once, already formatted
+        tables_by_id = {}
+        for excel_filename in sorted(reshaped_tables):
+            file_id = excel_filename.split('_')[0]
+            # Typed as if read back from its own xlsx, like the files concatenated on disk
+            tables_by_id.setdefault(file_id, []).append(as_read_from_excel(reshaped_tables[excel_filename]))
+
+        concatenated_folder = os.path.join(self.folder_path, "concatenated")
+        if not os.path.exists(concatenated_folder):
+            os.makedirs(concatenated_folder)
+
+        for file_id, dfs in tables_by_id.items():
+            concatenated_df = as_read_from_excel(pd.concat(dfs, axis=0, ignore_index=True))
+            file_path = os.path.join(concatenated_folder, f"{file_id}.xlsx")
+            print(file_path)
+            format_patient_table(concatenated_df).to_excel(file_path, index=False)
+            if documents is not None:
+                self.record_stage(documents.get(file_id, []), 'formatted')
+
+    def reshape_data(self, pdf_paths=None, progress=None):
+        # Reshapes the page xlsx of the given PDFs (every xlsx of the folder by default); a
+        # document that cannot be reshaped fails alone
         generated_files_path = os.path.join(self.folder_path)
+        if progress is None:
+            progress = DocumentProgress()
+        documents = {os.path.splitext(os.path.basename(pdf_path))[0]: pdf_path
+                     for pdf_path in (self.pdf_files() if pdf_paths is None else pdf_paths)}
 
+        files_by_document = {}
         for filename in os.listdir(generated_files_path):
             if filename.endswith('.xlsx'):
-                file_path = os.path.join(generated_files_path, filename)
-                df = pd.read_excel(file_path)
-                reshaper = DataReshaper(df)
-                reshaped_df = reshaper.reshape()
+                base_name = filename.rsplit('_', 1)[0]
+                if pdf_paths is None or base_name in documents:
+                    files_by_document.setdefault(base_name, []).append(filename)
+
+        for base_name, filenames in files_by_document.items():
+            # All pages of a document are reshaped before any is rewritten, so an interrupted
+            # run does not leave a document half reshaped
+            pdf_path = documents.get(base_name, os.path.join(generated_files_path, f'{base_name}.pdf'))
+            reshaped_dfs = {}
+            try:
+                for filename in filenames:
+                    file_path = os.path.join(generated_files_path, filename)
+                    df = pd.read_excel(file_path)
+                    reshaper = DataReshaper(df)
+                    reshaped_dfs[file_path] = reshaper.reshape()
+            except Exception as e:
+                progress.fail(pdf_path, e)
+                continue
+            for file_path, reshaped_df in reshaped_dfs.items():
                 reshaped_df.to_excel(file_path, index=False)
+            if pdf_paths is not None:
+                self.record_stage([pdf_path], 'reshaped')
+
+    def concatenate_excel_files(self, documents=None):
+        # documents: {patient ID: pdf paths} of the patients to concatenate, all of them by default
 
-    def concatenate_excel_files(self):
         # List all files in the given directory
         all_files = os.listdir(self.folder_path)
 
-        # Filter out the Excel files
-        excel_files = [f for f in all_files if f.endswith('.xlsx')]
+        # Filter out the Excel files, of the given patients only if any
+        excel_files = [f for f in all_files if f.endswith('.xlsx')
+                       and (documents is None or f.split('_')[0] in documents)]
 
         # Group files by ID
         files_by_id = {}
@@ -64,60 +566,97 @@ class MainPipeline:
             concatenated_df.to_excel(os.path.join(
                 concatenated_folder, f"{file_id}.xlsx"), index=False)
 
-    def format_excel(self):
+    def format_excel(self, documents=None):
+        # Only the patient files just concatenated should be given: formatting twice scales twice;
+        # the documents of each patient are recorded as soon as its file is formatted
         concatenated_id = os.path.join(self.folder_path, "concatenated")
         all_files = os.listdir(concatenated_id)
         for filename in all_files:
-            if filename.endswith(".xlsx"):
+            if filename.endswith(".xlsx") and (documents is None or filename[:-len(".xlsx")] in documents):
                 file_path = os.path.join(concatenated_id, filename)
 
-                df = pd.read_excel(file_path)
-
-                df["Date"] = pd.to_datetime(
-                    df["Date"], dayfirst=True).dt.strftime('%d/%m/%Y')
-
-                # I assume that if % not in column name then it is in L
-                no_perc = [
-                    e for e in df.columns if "%" not in e and "Date" not in e]
-                perc = [e for e in df.columns if "%" in e]
-                for c in no_perc:
-                    df[c] = df[c]*1000
-
-                for c in perc:
-                    df[c] = df[c]/100
+                df = format_patient_table(pd.read_excel(file_path))
 
                 print(file_path)
                 df.to_excel(file_path, index=False)
+                if documents is not None:
+                    self.record_stage(documents[filename[:-len(".xlsx")]], 'formatted')
 
     def run(self):
         start_time = time.time()
 
-        # Convert PDFs to Images
-        self.pdf_converter.convert_pdfs_to_images()
-        print(f"self.pdf_converter.convert_pdfs_to_images() done")
+        # Documents finished by an earlier run are skipped, the others resume where they stopped
+        stages = self.pending_documents()
+        if self.ledger is not None and not stages:
+            print("Every document is already in its patient file or failed in an earlier run, nothing to do")
+            return
+        ocr_paths = [pdf_path for pdf_path, stage in stages.items() if stage is None]
+        # Each document is recorded as soon as it is done; one that raises is set aside
+        # ('failed' in the ledger) and the others carry on
+        progress = DocumentProgress(self.ledger, self.remove_document_files)
+
+        post_ocr_in_memory = self.fused or self.shared_memory
+        if post_ocr_in_memory:
+            if self.shared_memory:
+                # Pages streamed through the render, preprocess and OCR pools in shared memory
+                reshaped_tables = self.process_pdfs_shared(ocr_paths, progress)
+                print(f"self.process_pdfs_shared() done")
+            else:
+                # Each PDF goes through every stage, up to the reshape, in a single pool task
+                reshaped_tables = self.process_pdfs_fused(ocr_paths, progress)
+                print(f"self.process_pdfs_fused() done")
+
+            # Documents whose tables an earlier run kept are not OCR'd again
+            for pdf_path, stage in stages.items():
+                if stage == 'tables':
+                    reshaped_tables.update(self.ledger.tables(pdf_path))
+
+            # One formatted xlsx per patient, straight from the DataFrames
+            self.write_patient_tables(reshaped_tables, self.patient_documents(stages, progress))
+            print(f"self.write_patient_tables() done")
+        elif self.in_memory:
+            # Render, preprocess and OCR each PDF without touching the disk
+            self.process_pdfs_in_memory(ocr_paths, progress)
+            print(f"self.process_pdfs_in_memory() done")
+        else:
+            if self.ledger is not None:
+                # PNGs left by an interrupted run would be OCR'd again, over tables already reshaped
+                self.delete_intermediate_files()
+
+            # Convert PDF pages to images, each one preprocessed as soon as it is rendered
+            self.convert_and_preprocess_pages(ocr_paths, progress)
+            print(f"self.convert_and_preprocess_pages() done")
 
-        # Preprocess Images
-        self.image_preprocessor.process_images_in_folder()
-        print(f"self.image_preprocessor.process_images_in_folder() done")
+            # Extract Text from Images using OCR
+            self.ocr_folder(progress)
+            print(f"self.ocr_folder() done")
 
-        # Extract Text from Images using OCR
-        self.text_extractor.process_texts_in_folder()
-        print(f"self.text_extractor.process_texts_in_folder() done")
+        if not post_ocr_in_memory:
+            # Reshape the generated Excel data, of the documents not reshaped yet when resuming
+            self.reshape_data(None if self.ledger is None else
+                              [pdf_path for pdf_path, stage in stages.items()
+                               if stage != 'reshaped' and pdf_path not in progress.failed], progress)
+            print(f"self.reshape_data() done")
 
-        # Reshape the generated Excel data
-        self.reshape_data()
-        print(f"self.reshape_data() done")
+        # Delete intermediate files, unless they were asked for
+        if not self.debug_png:
+            self.delete_intermediate_files()
+            print(f"self.delete_intermediate_files() done")
 
-        # Delete intermediate files
-        self.delete_intermediate_files()
-        print(f"self.delete_intermediate_files() done")
+        if not post_ocr_in_memory:
+            # Concatenate excel file for each patient, only the pending ones when resuming
+            documents = None if self.ledger is None else self.patient_documents(stages, progress)
+            self.concatenate_excel_files(documents)
+            print(f"self.concatenate_excel_files() done")
 
-        # Concatenate excel file for each patient
-        self.concatenate_excel_files()
-        print(f"self.concatenate_excel_files() done")
+            self.format_excel(documents)
+            print(f"self.format_excel() done")
 
-        self.format_excel()
-        print(f"self.format_excel() done")
+        # Documents without any results table get no patient file, and are done all the same
+        self.record_stage([pdf_path for pdf_path in stages if pdf_path not in progress.failed
+                           and not os.path.exists(self.patient_file(pdf_path))], 'formatted')
+        if progress.failed:
+            print(f"{len(progress.failed)} document(s) failed: {', '.join(map(os.path.basename, progress.failed))}")
 
         end_time = time.time()
         duration = end_time - start_time
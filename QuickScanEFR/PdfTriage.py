@@ -0,0 +1,441 @@
+# Tri des PDF avant extraction : chaque fichier est ouvert une seule fois pour savoir
+# s'il contient du texte sélectionnable, s'il est au format Word "SERVICE EFR" ou s'il est scanné.
+
+import argparse
+import json
+import os
+import re
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+from pypdf.errors import EmptyFileError, PdfStreamError
+from SQLiteStore import SQLiteStore, file_hash
+
+
+SERVICE_EFR_MARKERS = ("SERVICE EFR", "HOPITAL FOCH")
+
+# selectable: at least one page has extractable text
+# has_service_efr: True/False, or None when reading stopped before it could be settled
+# scanned: no text layer at all (the OCRobot branch)
+# error: message of the exception raised while reading the file, if any
+# image_pages: 1-based numbers of the pages without text, None when not every page was read
+TriageVerdict = namedtuple(
+    'TriageVerdict', ['selectable', 'has_service_efr', 'scanned', 'error', 'image_pages'],
+    defaults=(None,))
+
+
+# Text-showing operators and their string operands: "(..) Tj", "<..> Tj", "(..) '", "[..] TJ"
+LITERAL_STRING = rb"\((?:[^()\\]|\\.)*\)"
+HEX_STRING = rb"<[0-9A-Fa-f\s]*>"
+STRING_PATTERN = re.compile(LITERAL_STRING + rb"|" + HEX_STRING, re.S)
+TEXT_SHOWING_PATTERN = re.compile(
+    rb"(" + LITERAL_STRING + rb"|" + HEX_STRING + rb")\s*(?:Tj|'|\")"
+    rb"|\[((?:" + LITERAL_STRING + rb"|" + HEX_STRING + rb"|[^\]()<])*)\]\s*TJ", re.S)
+BLANK_BYTES = b" \t\r\n\x00"
+
+
+def _font_subtypes(resources, depth=0):
+    # Subtypes of the fonts reachable from a resource dictionary, form XObjects included
+    subtypes = set()
+    resources = resources.get_object() if resources is not None else None
+    if not resources:
+        return subtypes
+    fonts = resources.get('/Font')
+    if fonts:
+        for font in fonts.get_object().values():
+            subtypes.add(font.get_object().get('/Subtype'))
+    xobjects = resources.get('/XObject')
+    if xobjects and depth < 3:
+        for xobject in xobjects.get_object().values():
+            xobject = xobject.get_object()
+            if xobject.get('/Subtype') == '/Form':
+                subtypes |= _font_subtypes(xobject.get('/Resources'), depth + 1)
+    return subtypes
+
+
+def _is_visible_string(operand):
+    if operand.startswith(b"("):
+        content = operand[1:-1]
+    else:
+        digits = re.sub(rb"\s", b"", operand[1:-1])
+        content = bytes.fromhex((digits + b"0" * (len(digits) % 2)).decode())
+    return bool(content.strip(BLANK_BYTES))
+
+
+def _shows_visible_string(content_data):
+    for match in TEXT_SHOWING_PATTERN.finditer(content_data):
+        operand, array = match.groups()
+        operands = [operand] if operand is not None else STRING_PATTERN.findall(array)
+        if any(_is_visible_string(string) for string in operands):
+            return True
+    return False
+
+
+def probe_text_layer(page):
+    """
+    Cheap check of a page's text layer from its resources and content stream.
+
+    Returns:
+        bool or None: False when the page cannot draw any text (no font at all),
+        True when it shows a non-blank string with a simple font, None when
+        only extract_text can tell (composite fonts, text inside form XObjects...).
+    """
+    try:
+        font_subtypes = _font_subtypes(page.get('/Resources'))
+        if not font_subtypes:
+            return False
+        contents = page.get_contents()
+        data = contents.get_data() if contents is not None else b""
+        if _shows_visible_string(data):
+            # Two-byte glyph codes of composite fonts can map blank glyphs to any value
+            return None if '/Type0' in font_subtypes else True
+        return None
+    except Exception:
+        return None
+
+
+def classify_pdf(pdf_path, stop_at_text=False, probe=True):
+    """
+    Opens a PDF once and classifies it in a single pass over its pages.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        stop_at_text (bool): Stop at the first page with text. Enough to tell
+            scanned from selectable, but has_service_efr may be left to None.
+        probe (bool): Settle pages with probe_text_layer when it can, and only
+            run the full extract_text on the others.
+
+    Returns:
+        TriageVerdict: selectable / has_service_efr / scanned flags and the image-only pages.
+    """
+    selectable = False
+    image_pages = []
+    try:
+        with open(pdf_path, 'rb') as pdf_file:
+            pdf_reader = PdfReader(pdf_file)
+            for page_number, page in enumerate(pdf_reader.pages, start=1):
+                has_text = probe_text_layer(page) if probe else None
+                if has_text is False:
+                    image_pages.append(page_number)
+                    continue
+                if has_text and stop_at_text:
+                    return TriageVerdict(True, None, False, None)
+                # The SERVICE EFR check needs the text itself
+                text = page.extract_text()
+                if not text.strip():
+                    image_pages.append(page_number)
+                    continue
+                selectable = True
+                upper_text = text.upper()
+                if any(marker in upper_text for marker in SERVICE_EFR_MARKERS):
+                    # Nothing left to learn from the other pages
+                    return TriageVerdict(True, True, False, None)
+                if stop_at_text:
+                    return TriageVerdict(True, None, False, None)
+    except (PdfStreamError, EmptyFileError) as e:
+        # Unreadable files have no text layer we could find
+        print(f"Error processing file {pdf_path}: {e}")
+        return TriageVerdict(False, False, True, str(e))
+    except Exception as e:
+        print(f"Error processing {pdf_path}: {e}")
+        return TriageVerdict(False, False, False, str(e))
+    return TriageVerdict(selectable, False, not selectable, None, tuple(image_pages))
+
+
+def is_settled(verdict):
+    # Verdicts worth caching: a clean read, or a file pypdf cannot read (PdfStreamError, EmptyFileError,
+    # taken as scanned); any other error may be transient, and the file is parsed again next run
+    return verdict.error is None or verdict.scanned
+
+
+def is_hybrid(verdict):
+    # Text on some pages, only images on others: each kind of page needs its own extraction
+    return verdict.selectable and bool(verdict.image_pages)
+
+
+PAGE_MANIFEST = 'pages.json'
+
+
+def update_page_manifest(folder, image_pages_by_file):
+    """Records, per copied filename, the image-only pages found during triage."""
+    manifest_path = os.path.join(folder, PAGE_MANIFEST)
+    manifest = read_page_manifest(folder)
+    manifest.update({filename: list(pages) for filename, pages in image_pages_by_file.items()})
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def read_page_manifest(folder):
+    manifest_path = os.path.join(folder, PAGE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+class TriageCache(SQLiteStore):
+    """
+    On-disk cache of triage verdicts so unchanged PDFs are not parsed again on the next run.
+
+    Entries are keyed by absolute path, size and modification time. With
+    use_hash, the SHA-256 of the file content is checked as well, and a file
+    that was moved or touched without being modified is still a hit. Only
+    settled verdicts are stored (is_settled).
+    """
+
+    FILENAME = 'triage_cache.sqlite'
+    TABLE = 'verdicts'
+    COLUMNS = ("path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT, "
+               "selectable INTEGER, has_service_efr INTEGER, scanned INTEGER, error TEXT, "
+               "image_pages TEXT")
+    INDEXES = (('verdicts_content', 'size, content_hash'),)
+    SCHEMA_VERSION = 2
+    COMMIT_EVERY = 500
+
+    def __init__(self, folder, use_hash=False):
+        super().__init__(folder)
+        self.use_hash = use_hash
+        self.hits = 0
+        self.misses = 0
+        self._pending_writes = 0
+
+    def file_key(self, pdf_path):
+        try:
+            stat = os.stat(pdf_path)
+            content_hash = file_hash(pdf_path) if self.use_hash else None
+        except OSError:
+            return None
+        return (os.path.abspath(pdf_path), stat.st_size, stat.st_mtime_ns, content_hash)
+
+    def lookup(self, pdf_path, stop_at_text=False):
+        """
+        Returns (verdict, key). verdict is None on a miss; key is passed back to store().
+        """
+        key = self.file_key(pdf_path)
+        row = None
+        if key is not None:
+            path, size, mtime_ns, content_hash = key
+            columns = "selectable, has_service_efr, scanned, error, image_pages"
+            if content_hash is None:
+                row = self.connection.execute(
+                    f"SELECT {columns} FROM verdicts WHERE path = ? AND size = ? AND mtime_ns = ?",
+                    (path, size, mtime_ns)).fetchone()
+            else:
+                row = self.connection.execute(
+                    f"SELECT {columns} FROM verdicts WHERE size = ? AND content_hash = ? "
+                    "ORDER BY path = ? DESC LIMIT 1",
+                    (size, content_hash, path)).fetchone()
+        verdict = None
+        if row is not None:
+            selectable, has_service_efr, scanned, error, image_pages = row
+            if image_pages is not None:
+                image_pages = tuple(int(page) for page in image_pages.split(',') if page)
+            verdict = TriageVerdict(
+                bool(selectable), None if has_service_efr is None else bool(has_service_efr),
+                bool(scanned), error, image_pages)
+            # A verdict cut short at the first text page cannot answer the SERVICE EFR question
+            if verdict.has_service_efr is None and not stop_at_text:
+                verdict = None
+        if verdict is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return verdict, key
+
+    def store(self, key, verdict):
+        if key is None or not is_settled(verdict):
+            return
+        image_pages = None
+        if verdict.image_pages is not None:
+            image_pages = ','.join(str(page) for page in verdict.image_pages)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (verdict.selectable, verdict.has_service_efr, verdict.scanned, verdict.error,
+                   image_pages))
+        self._pending_writes += 1
+        if self._pending_writes >= self.COMMIT_EVERY:
+            self.connection.commit()
+            self._pending_writes = 0
+
+    def clear(self, path_prefix=None):
+        """Invalidates every entry, or only those under path_prefix. Returns the number removed."""
+        if path_prefix is None:
+            return super().clear()
+        prefix = os.path.abspath(path_prefix)
+        # The folder itself and what lies under it, not its siblings sharing the name's start
+        folder = prefix.rstrip(os.sep) + os.sep
+        cursor = self.connection.execute(
+            "DELETE FROM verdicts WHERE path = ? OR substr(path, 1, ?) = ?",
+            (prefix, len(folder), folder))
+        self.connection.commit()
+        return cursor.rowcount
+
+    def close(self):
+        super().close()
+        # Only a triage run looks verdicts up; clear-cache has nothing to report
+        if self.hits or self.misses:
+            print(f"Triage cache: {self.hits} hits, {self.misses} misses ({self.db_path})")
+
+
+def _lookup(cache, pdf_path, stop_at_text):
+    if cache is None:
+        return None, None
+    return cache.lookup(pdf_path, stop_at_text)
+
+
+def _resolve(entry, cache):
+    pdf_path, key, future, verdict = entry
+    if future is not None:
+        verdict = future.result()
+        if cache is not None:
+            cache.store(key, verdict)
+    return pdf_path, verdict
+
+
+def triage_pdfs(pdf_paths, workers=1, stop_at_text=False, cache=None, executor=None):
+    """
+    Classifies PDFs, optionally over a process pool, and yields the verdicts in input order.
+
+    pdf_paths can be a lazy generator (e.g. an os.walk in progress): files are
+    submitted to the pool as they are discovered. Yielding in input order keeps
+    any reduction done by the caller identical to the serial run.
+
+    Args:
+        pdf_paths (iterable): Paths of the PDF files to classify.
+        workers (int): Number of worker processes, 1 to classify in this process.
+        stop_at_text (bool): Forwarded to classify_pdf.
+        cache (TriageCache): Optional cache; only misses are parsed.
+        executor (ProcessPoolExecutor): Pool to classify on, e.g. one shared by
+            several calls; otherwise a pool of workers processes is started.
+
+    Yields:
+        tuple: (pdf_path, TriageVerdict)
+    """
+    if executor is None and (not workers or workers <= 1):
+        for pdf_path in pdf_paths:
+            verdict, key = _lookup(cache, pdf_path, stop_at_text)
+            if verdict is None:
+                verdict = classify_pdf(pdf_path, stop_at_text)
+                if cache is not None:
+                    cache.store(key, verdict)
+            yield pdf_path, verdict
+        return
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from _triage_on(executor, pdf_paths, workers, stop_at_text, cache)
+        return
+    yield from _triage_on(executor, pdf_paths, workers or os.cpu_count() or 1, stop_at_text, cache)
+
+
+def _triage_on(executor, pdf_paths, workers, stop_at_text, cache):
+    # Bounded window of in-flight files so results flow back while the walk is still running
+    max_pending = workers * 4
+    pending = deque()
+    for pdf_path in pdf_paths:
+        verdict, key = _lookup(cache, pdf_path, stop_at_text)
+        future = None if verdict else executor.submit(classify_pdf, pdf_path, stop_at_text)
+        pending.append((pdf_path, key, future, verdict))
+        while pending and (len(pending) >= max_pending
+                           or pending[0][2] is None or pending[0][2].done()):
+            yield _resolve(pending.popleft(), cache)
+    while pending:
+        yield _resolve(pending.popleft(), cache)
+
+
+
+def ipp_and_date_from_filename(filename):
+    # Filenames are in the format "IPP_date_other-id-for-specific-document.pdf"
+    parts = filename.split('_')
+    if len(parts) >= 2:
+        return parts[0], parts[1]
+    return None, None
+
+
+def plan_latest_per_ipp(pdf_paths, is_candidate, workers=1, stop_at_text=False, cache=None):
+    """
+    Finds the newest qualifying PDF of each IPP while classifying as few files as possible.
+
+    Every filename is indexed by IPP and date first. Candidates are then
+    classified newest-first, one round at a time over the IPPs still
+    unresolved, and an IPP is settled by its first qualifying file. Files with
+    the same date keep their walk order, so the winners are the files the
+    serial copy_pdfs_with_criteria loop would have left last.
+
+    Args:
+        pdf_paths (iterable): Paths of the PDF files to consider.
+        is_candidate (callable): Takes a TriageVerdict, True if the file qualifies.
+        workers (int): Processes of the pool shared by all the rounds, 1 to classify in this process.
+        stop_at_text (bool): Forwarded to triage_pdfs.
+        cache (TriageCache): Forwarded to triage_pdfs.
+
+    Returns:
+        dict: IPP -> (path, TriageVerdict) of the winning PDF.
+    """
+    candidates = defaultdict(list)
+    indexed_files = 0
+    for pdf_path in pdf_paths:
+        ipp, date = ipp_and_date_from_filename(os.path.basename(pdf_path))
+        # Same rule as the serial loop: only dates newer than the default one can win
+        if ipp is None or not date > '0000-00-00':
+            print(f"Skipping {pdf_path}: no IPP_date prefix in the filename")
+            continue
+        candidates[ipp].append((date, pdf_path))
+        indexed_files += 1
+
+    # Stable sort: equal dates stay in walk order
+    queues = {ipp: deque(sorted(files, key=lambda f: f[0], reverse=True))
+              for ipp, files in candidates.items()}
+    winners = {}
+    classified_files = 0
+    superseded_files = 0
+    # One pool for all the rounds: starting one per round costs more than the later rounds' few files
+    executor = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+    try:
+        while queues:
+            # One round classifies the newest remaining candidate of every unresolved IPP
+            round_files = [(ipp, queue.popleft()) for ipp, queue in queues.items()]
+            verdicts = triage_pdfs((pdf_path for _, (_, pdf_path) in round_files), workers, stop_at_text, cache,
+                                   executor)
+            for (ipp, (date, _)), (pdf_path, verdict) in zip(round_files, verdicts):
+                classified_files += 1
+                if is_candidate(verdict):
+                    winners[ipp] = (pdf_path, verdict)
+                    # Older exams the serial loop may have copied before reaching this one
+                    superseded_files += sum(1 for older_date, _ in queues[ipp] if older_date < date)
+                    del queues[ipp]
+                elif not queues[ipp]:
+                    del queues[ipp]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print(f"Planner: {indexed_files} files indexed over {len(candidates)} IPPs, "
+          f"{classified_files} classified, {indexed_files - classified_files} parses avoided")
+    print(f"Planner: {len(winners)} files to copy, "
+          f"up to {superseded_files} copies of superseded exams avoided")
+    return winners
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the PDF triage cache of an output folder.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    clear_parser = subparsers.add_parser('clear-cache', help="Invalidate cached verdicts")
+    clear_parser.add_argument('output_folder', help="Folder holding triage_cache.sqlite")
+    clear_parser.add_argument('--prefix', help="Only invalidate PDFs under this path")
+    triage_parser = subparsers.add_parser('triage', help="Classify PDFs through the cache and print the verdicts")
+    triage_parser.add_argument('output_folder', help="Folder holding triage_cache.sqlite")
+    triage_parser.add_argument('pdfs', nargs='+', help="PDF files to classify")
+    triage_parser.add_argument('--workers', type=int, default=1, help="Worker processes")
+    triage_parser.add_argument('--use-hash', action='store_true',
+                               help="Also key the verdicts by file content, so moved or touched files are hits")
+    args = parser.parse_args()
+
+    if args.command == 'clear-cache':
+        cache = TriageCache(args.output_folder)
+        removed = cache.clear(args.prefix)
+        print(f"Removed {removed} cached verdicts")
+    else:
+        cache = TriageCache(args.output_folder, args.use_hash)
+        for pdf_path, verdict in triage_pdfs(args.pdfs, args.workers, cache=cache):
+            print(f"{pdf_path}: {verdict}")
+    cache.close()
@@ -0,0 +1,84 @@
+# Base commune des petites bases SQLite posées à côté des fichiers traités
+# (cache du tri des PDF, cache OCR, journal des documents d'OCRobot).
+
+import hashlib
+import os
+import sqlite3
+import sys
+
+
+class SQLiteStore:
+    """
+    One SQLite table in a file of the folder it describes.
+
+    Subclasses give FILENAME, TABLE, its COLUMNS and INDEXES. SCHEMA_VERSION is
+    bumped whenever the columns change: a file written with another version has
+    its table dropped. The connection is opened on first use and left out when
+    the store is pickled, so a store travelling to pool workers opens its own.
+    """
+
+    FILENAME = None
+    TABLE = None
+    COLUMNS = None
+    # (name, columns) of the indexes of the table
+    INDEXES = ()
+    SCHEMA_VERSION = 1
+    # Write-ahead log, for files written by several processes at once
+    WAL = False
+
+    def __init__(self, folder):
+        self.db_path = os.path.join(folder, self.FILENAME)
+        self._connection = None
+
+    def __getstate__(self):
+        # sqlite3 connections cannot be pickled
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # Several processes may share the file: wait on locks instead of failing
+            self._connection = sqlite3.connect(self.db_path, timeout=60)
+            if self._connection.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+                self._connection.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+                self._connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            if self.WAL:
+                self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute(f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({self.COLUMNS})")
+            for name, columns in self.INDEXES:
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {self.TABLE} ({columns})")
+            self._connection.commit()
+        return self._connection
+
+    def clear(self):
+        cursor = self.connection.execute(f"DELETE FROM {self.TABLE}")
+        self.connection.commit()
+        return cursor.rowcount
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+
+
+def file_hash(path):
+    # SHA-256 of a file's content, read by chunks
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clear_command(store_class):
+    # Command line of the stores: python <module>.py clear <folder>
+    script = os.path.basename(sys.argv[0])
+    if len(sys.argv) != 3 or sys.argv[1] != 'clear':
+        sys.exit(f"Usage: python {script} clear <folder>")
+    store = store_class(sys.argv[2])
+    store.clear()
+    store.close()
+    print(f"Cleared {store.db_path}")
@@ -1,56 +1,36 @@
-from pypdf import PdfReader
+import argparse
 import camelot
 import shutil
 import os
+import sys
 from collections import defaultdict
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PdfTriage import (TriageCache, classify_pdf, ipp_and_date_from_filename, is_hybrid,
+                       plan_latest_per_ipp, triage_pdfs, update_page_manifest)
 
 
 def is_selectable_text(pdf_path):
     print("-------------- Checking if text is selectable --------------")
-    # Check if the PDF contains selectable text using PyPDF2
-    try:
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text = page.extract_text()
-                if text.strip():
-                    return True
-        return False
-    except Exception as e:
-        if str(e) == "Cannot read an empty file":
-            print(f"Empty file encountered: {pdf_path}")
-            return False
-        else:
-            print(f"Error processing {pdf_path}: {e}")
-            return False
+    # Check if the PDF contains selectable text
+    return classify_pdf(pdf_path, stop_at_text=True).selectable
 
 
 def does_not_contain_service_efr(pdf_path):
     # Check if the PDF does not contain "SERVICE EFR" or "HOPITAL FOCH" in any of its pages
     print("-------------- Checking if pdf in the word format --------------")
-    try:
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_reader = PdfReader(pdf_file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text = page.extract_text()
-                if "SERVICE EFR" in text.upper() or "HOPITAL FOCH"  in text.upper():  # Case-insensitive check
-                    return False
-        return True
-    except Exception as e:
-        if str(e) == "Cannot read an empty file":
-            print(f"Empty file encountered: {pdf_path}")
-            return False
-        else:
-            print(f"Error processing {pdf_path}: {e}")
-            return False
+    verdict = classify_pdf(pdf_path)
+    return verdict.error is None and not verdict.has_service_efr
+
+
+def is_textmachina_candidate(verdict):
+    # Selectable text and no "SERVICE EFR" or "HOPITAL FOCH" header
+    return verdict.selectable and not verdict.has_service_efr
 
 
 def extract_tables(pdf_path):
     print("-------------- Extracting with camelot --------------")
     try:
-        if is_selectable_text(pdf_path) and does_not_contain_service_efr(pdf_path):
+        if is_textmachina_candidate(classify_pdf(pdf_path)):
             # Use Camelot to extract tables from PDF with selectable text and no "SERVICE EFR" or "HOPITAL FOCH"
             tables = camelot.read_pdf(pdf_path, flavor='stream', pages='all')
             return tables
@@ -63,61 +43,90 @@ def extract_tables(pdf_path):
             return False
 
 
-
-def get_id_and_date_from_filename(filename):
-    print("-------------- Formatting IPP  --------------")
-    try:
-        parts = filename.split('_')
-        if len(parts) >= 2:
-            return parts[0], parts[1]
-        return None, None
-    except Exception as e:
-        if str(e) == "Cannot read an empty file":
-            print(f"Empty file encountered: {filename}")
-            return False
-        else:
-            print(f"Error processing {filename}: {e}")
-            return False
-
-
-
-def copy_pdfs_with_criteria(input_folder, output_folder):
-    latest_files = defaultdict(lambda: ('', '0000-00-00'))
-
+def iter_pdf_files(input_folder):
     for root, _, files in os.walk(input_folder):
         print(f"Currently scanning: {root}")
         for filename in files:
             print(f"Checking file: {filename}")
             if filename.endswith('.pdf'):
-                pdf_path = os.path.join(root, filename)
-                selectable = is_selectable_text(pdf_path)
-                no_service_efr = does_not_contain_service_efr(pdf_path)
-                print(f"Selectable: {selectable}, No Service EFR: {no_service_efr}")
-                if selectable and no_service_efr:
-                    id, date = get_id_and_date_from_filename(filename)
-                    print(f"ID: {id}, Date: {date}, Latest Date: {latest_files[id][1]}")
-                    if date > latest_files[id][1]:
-                        latest_files[id] = (pdf_path, date)
-                        destination_path = os.path.join(output_folder, filename)
-                        print(f"Attempting to copy {pdf_path} to {destination_path}")
-                        try:
-                            shutil.copy(pdf_path, destination_path)
-                            print(f"Successfully copied {filename}")
-                        except Exception as e:
-                            if str(e) == "Cannot read an empty file":
-                                print(f"Empty file encountered: {filename}")
-                                return False
-                            else:
-                                print(f"Error processing {filename}: {e}")
-                                return False
-
-def main():
+                yield os.path.join(root, filename)
+
+
+def copy_pdfs_with_criteria(input_folder, output_folder, workers=1, cache=None):
+    latest_files = defaultdict(lambda: ('', '0000-00-00'))
+
+    # With workers > 1 the PDFs are classified in a process pool while the walk goes on;
+    # verdicts still come back in walk order so the latest-file selection is unchanged
+    for pdf_path, verdict in triage_pdfs(iter_pdf_files(input_folder), workers, cache=cache):
+        filename = os.path.basename(pdf_path)
+        print(f"Selectable: {verdict.selectable}, No Service EFR: {not verdict.has_service_efr}")
+        if is_textmachina_candidate(verdict):
+            id, date = ipp_and_date_from_filename(filename)
+            print(f"ID: {id}, Date: {date}, Latest Date: {latest_files[id][1]}")
+            if date > latest_files[id][1]:
+                latest_files[id] = (pdf_path, date)
+                destination_path = os.path.join(output_folder, filename)
+                print(f"Attempting to copy {pdf_path} to {destination_path}")
+                try:
+                    shutil.copy(pdf_path, destination_path)
+                    print(f"Successfully copied {filename}")
+                except Exception as e:
+                    if str(e) == "Cannot read an empty file":
+                        print(f"Empty file encountered: {filename}")
+                        return False
+                    else:
+                        print(f"Error processing {filename}: {e}")
+                        return False
+
+
+def copy_latest_pdfs(input_folder, output_folder, workers=1, cache=None, hybrid_folder=None):
+    # Only the newest qualifying exam of each IPP is classified and copied, older ones are skipped
+    winners = plan_latest_per_ipp(iter_pdf_files(input_folder), is_textmachina_candidate,
+                                  workers, cache=cache)
+    hybrid_pages = {}
+    for pdf_path, verdict in winners.values():
+        filename = os.path.basename(pdf_path)
+        # Reports mixing text and scanned pages go to the hybrid branch, which routes each page
+        if hybrid_folder is not None and is_hybrid(verdict):
+            destination_path = os.path.join(hybrid_folder, filename)
+            hybrid_pages[filename] = verdict.image_pages
+        else:
+            destination_path = os.path.join(output_folder, filename)
+        print(f"Attempting to copy {pdf_path} to {destination_path}")
+        try:
+            shutil.copy(pdf_path, destination_path)
+            print(f"Successfully copied {filename}")
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            hybrid_pages.pop(filename, None)
+    if hybrid_pages:
+        update_page_manifest(hybrid_folder, hybrid_pages)
+
+
+def main(use_hash=False, workers=None):
+    # use_hash: also key the cached verdicts by file content, so moved or touched PDFs are hits
+    # workers: processes classifying PDFs, 1 for a serial run (default: one per CPU)
     input_folder = "C:/Users/benysar/Desktop/LUTECE/extract_easily"
     output_folder = "C:/Users/benysar/Desktop/Github/OCR_EFR/QuickScanEFR/pdf_TextMachina/"
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    copy_pdfs_with_criteria(input_folder, output_folder)
+    hybrid_folder = "C:/Users/benysar/Desktop/Github/OCR_EFR/QuickScanEFR/pdf_Hybrid/"
+    if workers is None:
+        workers = os.cpu_count() or 1
+    for folder in [output_folder, hybrid_folder]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    # Verdicts of unchanged PDFs are reused from the previous runs
+    cache = TriageCache(output_folder, use_hash)
+    try:
+        copy_latest_pdfs(input_folder, output_folder, workers, cache, hybrid_folder)
+    finally:
+        cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Copy the newest SERVICE EFR PDF of each IPP to pdf_TextMachina.")
+    parser.add_argument('--use-hash', action='store_true',
+                        help="Also key the cached verdicts by file content")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes classifying PDFs, 1 for a serial run (default: one per CPU)")
+    args = parser.parse_args()
+    main(args.use_hash, args.workers)
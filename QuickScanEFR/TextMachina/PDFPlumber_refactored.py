@@ -13,13 +13,13 @@ class PDFProcessor:
         print(f"Output directory: {self.output_path}")
         os.makedirs(self.output_path, exist_ok=True)
 
-    def process_pdf(self, pdf_path, output_path):
+    def process_pdf(self, pdf_path, output_path, pages='1-end'):
         try:
             if not os.path.exists(pdf_path):
                 raise FileNotFoundError(f"PDF file not found: {pdf_path}")
                 
             print(f"Processing PDF: {pdf_path}")
-            tables = camelot.read_pdf(pdf_path, pages='1-end', flavor="lattice", strip_text='\n')
+            tables = camelot.read_pdf(pdf_path, pages=pages, flavor="lattice", strip_text='\n')
             print(f"Extracted {len(tables)} tables from {os.path.basename(pdf_path)}")
             
             with pd.ExcelWriter(output_path) as writer:
@@ -30,7 +30,6 @@ class PDFProcessor:
             
         except Exception as e:
             print(f"Error processing PDF: {str(e)}")
-            self.handle_error(pdf_path, 'exception', str(e))
             return False
 
     def process_and_combine(self, pdf_path, output_path):
@@ -44,7 +43,8 @@ class PDFProcessor:
         try:
             print(f"Starting processing of {pdf_path}")
             # Uncommented the PDF processing step
-            self.process_pdf(pdf_path, output_path)
+            if not self.process_pdf(pdf_path, output_path):
+                return False
             print(f"PDF processed, combining data from {output_path}")
             combined_data = self.combine_data_horizontally(output_path)
             print("Data combined, saving final result")
@@ -53,7 +53,6 @@ class PDFProcessor:
             return True
         except Exception as e:
             print(f"Error processing {pdf_path}: {str(e)}")
-            self.handle_error(pdf_path, 'exception', str(e))
             return False
 
     def process_directory(self):
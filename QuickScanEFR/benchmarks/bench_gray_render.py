@@ -0,0 +1,65 @@
+# Compare deux façons d'obtenir une page en niveaux de gris pour le prétraitement d'OCRobot :
+# pdf2image en couleur + PNG relu avec cv2.IMREAD_GRAYSCALE (ancien chemin), et pdftoppm -gray
+# lu directement depuis sa sortie PGM (PdfConverter.render_page).
+#
+#   python bench_gray_render.py <folder> [--limit N]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'OCRobot'))
+from PdfToImageConverter_optimized import PdfConverter
+
+
+def time_png_path(converter, pdf_paths, tmp_dir):
+    images = []
+    start_time = time.perf_counter()
+    for pdf_path in pdf_paths:
+        converter.convert_pdf_to_image(pdf_path, tmp_dir)
+        image_path = os.path.join(tmp_dir, os.path.splitext(os.path.basename(pdf_path))[0] + '_0.png')
+        images.append(cv2.imread(image_path, cv2.IMREAD_GRAYSCALE))
+        os.remove(image_path)
+    return time.perf_counter() - start_time, images
+
+
+def time_gray_path(converter, pdf_paths):
+    start_time = time.perf_counter()
+    images = [converter.render_page(pdf_path) for pdf_path in pdf_paths]
+    return time.perf_counter() - start_time, images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark grayscale PGM rendering against RGB rendering + PNG.")
+    parser.add_argument('folder', help="Folder of sample scanned PDFs (searched recursively)")
+    parser.add_argument('--limit', type=int, default=None, help="Only use the first N PDFs")
+    args = parser.parse_args()
+
+    pdf_paths = [os.path.join(root, f) for root, _, files in os.walk(args.folder)
+                 for f in files if f.lower().endswith('.pdf')][:args.limit]
+    if not pdf_paths:
+        print("No PDF files found in the directory.")
+        return
+
+    converter = PdfConverter(args.folder)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        png_time, png_images = time_png_path(converter, pdf_paths, tmp_dir)
+    gray_time, gray_images = time_gray_path(converter, pdf_paths)
+
+    # Both paths should give the same page up to the RGB-to-gray rounding
+    differences = [np.abs(old.astype(int) - new.astype(int)).max() if old.shape == new.shape else None
+                   for old, new in zip(png_images, gray_images)]
+    same_shape = sum(difference is not None for difference in differences)
+    max_difference = max((difference for difference in differences if difference is not None), default=0)
+    print(f"{len(pdf_paths)} pages (first page of each PDF)")
+    print(f"  RGB + PNG + reload: {png_time:.2f} s ({png_time / len(pdf_paths) * 1000:.1f} ms/page)")
+    print(f"  grayscale PGM:      {gray_time:.2f} s ({gray_time / len(pdf_paths) * 1000:.1f} ms/page)")
+    print(f"  speedup x{png_time / gray_time:.1f}, same size for {same_shape}/{len(pdf_paths)} pages, "
+          f"max pixel difference {max_difference}")
+
+
+if __name__ == "__main__":
+    main()
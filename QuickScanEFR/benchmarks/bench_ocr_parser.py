@@ -0,0 +1,115 @@
+# Compare le parseur en une passe de TextExtractorFromImages à l'ancienne version
+# (fusion par pop() et sections.index() par mot-clé) sur des sorties Tesseract enregistrées :
+# fichiers .txt et/ou caches ocr_cache.sqlite d'OCRobot.
+#
+#   python bench_ocr_parser.py <folder> [--repeat N]
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'OCRobot'))
+from OCRProcessor_optimized import TextExtractorFromImages
+
+
+class LegacyTextExtractor(TextExtractorFromImages):
+    # Parser as it was before the single-pass version, kept as the reference
+
+    def _combine_occurrences(self, sections):
+        i = 0
+        while i < len(sections) - 1:
+            pair = (sections[i], sections[i+1])
+            if pair in self.COMBINE_PAIRS:
+                sections[i] = " ".join(pair)
+                sections.pop(i + 1)
+            else:
+                i += 1
+        return sections
+
+    def _extract_section(self, sections, start_keywords=None, end_keywords=None, end_offset=0):
+        if start_keywords:
+            start_idx = next((sections.index(
+                keyword) + 1 for keyword in start_keywords if keyword in sections), 0)
+        else:
+            start_idx = 0
+        if end_keywords:
+            end_idx = next((sections.index(
+                keyword) + end_offset for keyword in end_keywords if keyword in sections), len(sections))
+        else:
+            end_idx = len(sections)
+        return [item for item in sections[start_idx:end_idx] if item]
+
+    def _parse_text(self, text):
+        sections = text.split()
+
+        sections_set = set(sections)
+        end_keyword = ['VIMS'] if 'VIMS' in sections_set else ['DEM25']
+
+        sections = self._combine_occurrences(sections)
+        parameters_section = self._extract_section(
+            sections, None, end_keyword, 1)
+        theo_values = self._extract_section(
+            sections, self.THEO_KEYWORDS, self.PRE_KEYWORDS)
+        pre_values = self._extract_section(
+            sections, self.PRE_KEYWORDS, self.PERC_THEO_KEYWORDS)
+        perc_theo_values = self._extract_section(
+            sections, self.PERC_THEO_KEYWORDS)
+
+        theo_values = self._adjust_list_length(theo_values, parameters_section)
+        perc_theo_values = self._adjust_list_length(
+            perc_theo_values, parameters_section)
+
+        return {
+            'Paramètres': parameters_section,
+            'Théo': theo_values,
+            'Pré': pre_values,
+            '% Théo': perc_theo_values
+        }
+
+
+def load_texts(folder):
+    texts = []
+    for root, _, files in os.walk(folder):
+        for f in files:
+            path = os.path.join(root, f)
+            if f.lower().endswith('.txt'):
+                with open(path, encoding='utf-8') as text_file:
+                    texts.append(text_file.read())
+            elif f == 'ocr_cache.sqlite':
+                connection = sqlite3.connect(path)
+                texts.extend(text for text, in connection.execute("SELECT text FROM ocr_texts"))
+                connection.close()
+    return texts
+
+
+def time_parser(extractor, texts, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        results = [extractor._parse_text(text) for text in texts]
+    return time.perf_counter() - start_time, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the single-pass OCR text parser against the previous one.")
+    parser.add_argument('folder', help="Folder of Tesseract outputs (.txt files or ocr_cache.sqlite, searched recursively)")
+    parser.add_argument('--repeat', type=int, default=20, help="Parse every text N times")
+    args = parser.parse_args()
+
+    texts = load_texts(args.folder)
+    if not texts:
+        print("No OCR text found in the directory.")
+        return
+
+    legacy_time, legacy_results = time_parser(LegacyTextExtractor(args.folder), texts, args.repeat)
+    single_pass_time, single_pass_results = time_parser(TextExtractorFromImages(args.folder), texts, args.repeat)
+    agreements = sum(old == new for old, new in zip(legacy_results, single_pass_results))
+    parses = len(texts) * args.repeat
+    print(f"{len(texts)} OCR texts, {args.repeat} repeats")
+    print(f"  previous parser:    {legacy_time:.3f} s ({legacy_time / parses * 1e6:.1f} us/text)")
+    print(f"  single-pass parser: {single_pass_time:.3f} s ({single_pass_time / parses * 1e6:.1f} us/text)")
+    print(f"  speedup x{legacy_time / single_pass_time:.1f}, same columns for {agreements}/{len(texts)} texts")
+
+
+if __name__ == "__main__":
+    main()
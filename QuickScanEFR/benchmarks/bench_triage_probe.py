@@ -0,0 +1,48 @@
+# Compare le test rapide de la couche texte (probe_text_layer) à l'extraction complète
+# (extract_text) sur un dossier d'exemples de PDF.
+#
+#   python bench_triage_probe.py <folder> [--limit N]
+
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PdfTriage import classify_pdf
+
+
+def time_classification(pdf_paths, **options):
+    verdicts = []
+    start_time = time.perf_counter()
+    for pdf_path in pdf_paths:
+        verdicts.append(classify_pdf(pdf_path, **options))
+    return time.perf_counter() - start_time, verdicts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the text-layer probe against full text extraction.")
+    parser.add_argument('folder', help="Folder of sample PDFs (searched recursively)")
+    parser.add_argument('--limit', type=int, default=None, help="Only use the first N PDFs")
+    args = parser.parse_args()
+
+    pdf_paths = [os.path.join(root, f) for root, _, files in os.walk(args.folder)
+                 for f in files if f.lower().endswith('.pdf')][:args.limit]
+    if not pdf_paths:
+        print("No PDF files found in the directory.")
+        return
+
+    # Same two questions as the Checkingfile scripts: scanned or not (OCRobot), full verdict (TextMachina)
+    for label, stop_at_text in [("scanned check", True), ("full verdict", False)]:
+        full_time, full_verdicts = time_classification(pdf_paths, stop_at_text=stop_at_text, probe=False)
+        probe_time, probe_verdicts = time_classification(pdf_paths, stop_at_text=stop_at_text, probe=True)
+        agreements = sum(
+            full.selectable == fast.selectable and full.scanned == fast.scanned
+            for full, fast in zip(full_verdicts, probe_verdicts))
+        print(f"{label}: {len(pdf_paths)} files")
+        print(f"  extract_text: {full_time:.2f} s ({full_time / len(pdf_paths) * 1000:.1f} ms/file)")
+        print(f"  probe:        {probe_time:.2f} s ({probe_time / len(pdf_paths) * 1000:.1f} ms/file)")
+        print(f"  speedup x{full_time / probe_time:.1f}, same verdict for {agreements}/{len(pdf_paths)} files")
+
+
+if __name__ == "__main__":
+    main()
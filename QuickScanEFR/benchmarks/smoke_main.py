@@ -0,0 +1,32 @@
+# Essai de bout en bout du point d'entrée QuickScanEFR (main.main) sur un dossier temporaire
+# contenant un seul PDF scanné : vérifie que la branche OCRobot, avec ses pools de processus,
+# se termine et écrit le fichier patient.
+#
+#   python smoke_main.py <scanned.pdf>
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main as quickscan
+
+
+def smoke(pdf_path):
+    with tempfile.TemporaryDirectory() as root:
+        for folder in ['pdf_OCRobot', 'pdf_TextMachina']:
+            os.makedirs(os.path.join(root, folder))
+        shutil.copy(pdf_path, os.path.join(root, 'pdf_OCRobot'))
+        status = quickscan.main(root)
+        concatenated = os.path.join(root, 'pdf_OCRobot', 'concatenated')
+        patient_files = os.listdir(concatenated) if os.path.isdir(concatenated) else []
+        print(f"Exit status {status}, patient files {patient_files}")
+        return status == 0 and len(patient_files) == 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('pdf', help="Scanned report to run through OCRobot")
+    args = parser.parse_args()
+    sys.exit(0 if smoke(args.pdf) else 1)
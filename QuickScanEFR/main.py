@@ -1,15 +1,18 @@
 # Auteur : Sarra Ben Yahia
 # Point d'entrée principal de QuickScanEFR. Ce script vérifie les différents formats des fichiers PDF. Si le contenu du PDF est sélectionnable (c'est-à-dire rédigé manuellement par le médecin), alors TextMachina est exécuté. Dans le cas contraire, OCRobot est sollicité.
 
+import importlib
+import multiprocessing
 import os
+import sys
+import time
+import traceback
 import PyPDF2
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # Directory paths
 base_dir = os.path.dirname(os.path.abspath(__file__))
 pdf_dir = os.path.join(base_dir, 'pdf')
-pdf_textmachina_dir = os.path.join(base_dir, 'pdf_TextMachina')
-pdf_ocrobot_dir = os.path.join(base_dir, 'pdf_OCRobot')
 
 # # Create the folders if they don't exist
 # if not os.path.exists(pdf_textmachina_dir):
@@ -40,10 +43,74 @@ pdf_ocrobot_dir = os.path.join(base_dir, 'pdf_OCRobot')
 #                 os.rename(filepath, os.path.join(pdf_ocrobot_dir, filename))
 
 
-# Run OCRobot/main.py
-ocrobot_script = os.path.join(base_dir, 'OCRobot', 'main.py')
-subprocess.run(['python', ocrobot_script])
+def load_pipeline_class(branch):
+    # The branch modules import their siblings by bare name, e.g. "from ExcelFormatter import ...",
+    # and the branch's main is imported as a real module (OCRobot.main): the pool workers unpickle
+    # MainPipeline by that name, also when they are spawned with the parent's sys.path
+    for path in [base_dir, os.path.join(base_dir, branch)]:
+        if path not in sys.path:
+            sys.path.append(path)
+    return importlib.import_module(f"{branch}.main").MainPipeline
 
-# Run TextMachina/main.py
-textmachina_script = os.path.join(base_dir, 'TextMachina', 'main.py')
-subprocess.run(['python', textmachina_script])
\ No newline at end of file
+
+def run_branch(name, pipelines):
+    # The pipelines of a branch run one after the other
+    start_time = time.time()
+    try:
+        for pipeline in pipelines:
+            pipeline.run()
+        status = "ok"
+    except Exception:
+        traceback.print_exc()
+        status = "failed"
+    return name, status, time.time() - start_time
+
+
+def main(root=base_dir):
+    # root holds the pdf_OCRobot, pdf_TextMachina and pdf_Hybrid folders
+    start_time = time.time()
+    pdf_ocrobot_dir = os.path.join(root, 'pdf_OCRobot')
+    pdf_textmachina_dir = os.path.join(root, 'pdf_TextMachina')
+    pdf_hybrid_dir = os.path.join(root, 'pdf_Hybrid')
+
+    # Reports mixing text and scanned pages, routed page by page
+    run_hybrid = os.path.isdir(pdf_hybrid_dir) and any(
+        f.lower().endswith('.pdf') for f in os.listdir(pdf_hybrid_dir))
+
+    # One shared CPU budget: TextMachina, preceded by the hybrid routing, runs on a single core,
+    # OCRobot's pools get the others
+    cpu_count = os.cpu_count() or 2
+    ocrobot_workers = max(1, cpu_count - 1)
+    # The process pools are started from the branch threads: a forked worker would copy the
+    # locks the other branch holds at that moment, spawned workers start from a clean interpreter
+    mp_context = multiprocessing.get_context('spawn')
+
+    OCRobotPipeline = load_pipeline_class('OCRobot')
+    TextMachinaPipeline = load_pipeline_class('TextMachina')
+    textmachina = TextMachinaPipeline(input_directory=pdf_textmachina_dir,
+                                      output_directory=os.path.join(root, 'TextMachina', 'pdf_test'))
+    branches = [
+        ('OCRobot', [OCRobotPipeline(pdf_ocrobot_dir, max_workers=ocrobot_workers, fused=True,
+                                     all_pages=True, mp_context=mp_context)]),
+        ('TextMachina', [textmachina]),
+    ]
+    if run_hybrid:
+        # The merged tables of the hybrid branch are written to TextMachina's pdf_extracted and
+        # go through its corrections, so they must be there before TextMachina reads that folder
+        from HybridRouter import HybridPipeline
+        branches[1] = ('Hybrid + TextMachina', [HybridPipeline(pdf_hybrid_dir, textmachina.pdf_output), textmachina])
+
+    # The branches run at the same time; their heavy work happens in
+    # Tesseract, poppler and worker processes, so threads are enough to overlap them
+    with ThreadPoolExecutor(max_workers=len(branches)) as executor:
+        results = list(executor.map(lambda branch: run_branch(*branch), branches))
+
+    print("---------------- QuickScanEFR report ----------------")
+    for name, status, duration in results:
+        print(f"{name}: {status} in {duration:.2f} seconds")
+    print(f"Total: {time.time() - start_time:.2f} seconds")
+    return 0 if all(status == "ok" for _, status, _ in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())